@@ -1,20 +1,27 @@
 # 標準ライブラリ
+import collections
+import atexit
+import functools
 import gc
 import glob
 import inspect
+import json
+from multiprocessing import shared_memory
 import os
-import struct
+import sys
+import threading
 import time
 from datetime import datetime, timedelta
 
 # 外部ライブラリ
 import joblib
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
-from scipy import optimize
-from scipy.stats import spearmanr
+from scipy.stats import rankdata
 from sklearn import linear_model
 
 # これを入れないと警告が出てうざい。
@@ -23,215 +30,331 @@ register_matplotlib_converters()
 
 eps = 1.0e-5
 
+# 列ごとのバイナリファイルに保存する価格データの項目。
+price_fields = ['open', 'high', 'low', 'close', 'volume']
+
+# 銘柄ごとの1pipの大きさ（ない銘柄はget_pipで価格から推測する）。
+pip_size = {
+        'AUDCAD': 0.0001, 'AUDCHF': 0.0001, 'AUDJPY': 0.01, 'AUDNZD': 0.0001,
+        'AUDUSD': 0.0001, 'CADCHF': 0.0001, 'CADJPY': 0.01, 'CHFJPY': 0.01,
+        'EURAUD': 0.0001, 'EURCAD': 0.0001, 'EURCHF': 0.0001, 'EURGBP': 0.0001,
+        'EURJPY': 0.01, 'EURNZD': 0.0001, 'EURUSD': 0.0001, 'GBPAUD': 0.0001,
+        'GBPCAD': 0.0001, 'GBPCHF': 0.0001, 'GBPJPY': 0.01, 'GBPNZD': 0.0001,
+        'GBPUSD': 0.0001, 'NZDCAD': 0.0001, 'NZDCHF': 0.0001, 'NZDJPY': 0.01,
+        'NZDUSD': 0.0001, 'USDCAD': 0.0001, 'USDCHF': 0.0001, 'USDJPY': 0.01}
+
+# キャッシュ用のtempフォルダーのパス（get_temp_dirで設定する）。
+temp_dir = None
+
+# pklファイルの前段に置くメモリー上のLRUキャッシュ。
+# 戻り値は呼び出し元で共有されるので、インプレースで書き換えないこと。
+memory_cache = collections.OrderedDict()
+memory_cache_info = {'bytes': 0, 'max_bytes': 2*1024**3, 'hits': 0,
+                     'misses': 0}
+
+# tempフォルダーのpklファイルの管理情報（get_manifestで読み込む）。
+# エントリーごとに関数名、元データのフィンガープリント、依存するエントリー、
+# サイズ、最終アクセス時刻を記録する。
+cache_manifest = None
+cache_manifest_info = {'max_bytes': 20*1024**3, 'disk_hits': 0,
+                       'disk_misses': 0, 'invalidated': 0, 'evicted': 0,
+                       'deleted': set(), 'dirty': 0, 'saved': 0.0}
+
+# 計算中のi_*関数ごとに元データと依存するエントリーを集めるスタック。
+cache_stack = []
+
+# 1ならコンパクトモード（set_compact_modeで設定する）。
+# 価格とi_*関数の戻り値をfloat32で持ち、pklファイルには値だけを保存して
+# 時間インデックスは銘柄、時間足ごとのprice_indexを共有する。
+# float32の丸め誤差は値の2^-24（約6e-8）倍以下で、価格なら0.001pips未満。
+# ATRや変化率のように価格の差を取る値には、価格に対して約1.2e-7の誤差が出る。
+compact_mode = 0
+
+# publish_datasetで共有メモリーに置いたデータ（子プロセスではattach_datasetで
+# 設定する）。shared_blocksは作成またはアタッチしたSharedMemory、
+# shared_priceは銘柄、時間足ごとのデータセットのIDと元データの
+# フィンガープリントと項目ごとの価格、shared_cacheはキャッシュのキーごとの
+# i_*関数の戻り値と元データのフィンガープリント。配列は読み取り専用。
+shared_blocks = {}
+shared_price = {}
+shared_cache = {}
+
+# 1分足から作った時間足の価格データ（銘柄、時間足ごとに1分足の
+# time.npyの更新時刻と項目ごとの配列を持つ）。
+resampled_price = {}
+
+# calc_metricsの戻り値。
+Metrics = collections.namedtuple(
+        'Metrics', ['apr', 'sharpe', 'drawdown', 'r2', 'trade', 'skew',
+                    'kurt'])
+
+# backtest、backtest_mlでreport=2のときの戻り値。
+# tableは期間ごとの成績（ウォークフォワードでは最後の行が全期間）、
+# equityは資産曲線。
+BacktestResult = collections.namedtuple(
+        'BacktestResult', ['metrics', 'table', 'equity', 'pnl', 'inputs'])
+
+# 読み込んだ価格データの時間インデックス（銘柄、時間足ごとに共有する）。
+price_index = {}
+
+# 計算グラフにノードを追加する（依存するノードを先に追加する）。
+# ノードは(種類, 元のノード, パラメーター)のタプルで、同じタプルは1つにまとめる。
+# 'price'は(種類, 項目, シフト)、'lag'はシフト、'change'は変化率、'tr'は
+# ATRのトゥルーレンジ、'kairi'は移動平均乖離率、'sums'は元のノードの
+# calc_rolling_momentsの累積和を期間の間で使い回す辞書、'window'は
+# calc_rolling_windowの移動平均と移動分散（同じ期間の'var'がなければ
+# 移動平均だけ）、'mean'、'var'はその値、'max'、'min'、'skew'、'kurt'は
+# rolling()の各関数。
+def add_graph_node(graph, key):
+    if key in graph['nodes']:
+        return key
+    kind = key[0]
+    if kind == 'price':
+        deps = []
+    elif kind == 'change':
+        deps = [key[1], ('lag', key[1], 1)]
+    elif kind == 'tr':
+        shift = key[1][2]
+        deps = [('price', 'high', shift), ('price', 'low', shift),
+                ('lag', key[1], 1)]
+    elif kind == 'kairi':
+        deps = [key[1], ('mean', key[1], key[2])]
+    elif kind == 'window':
+        deps = [key[1], ('sums', key[1])]
+    elif kind == 'mean' or kind == 'var':
+        deps = [key[1], ('window', key[1], key[2])]
+    else:
+        deps = [key[1]]
+    for dep in deps:
+        add_graph_node(graph, dep)
+    graph['nodes'][key] = deps
+    return key
+
+# 計算グラフに指標を追加する（計算はevaluate_graphでまとめて行う）。
+# indicatorは'atr'、'hl_band'、'kairi'、'kurt'、'level'、'ma'、'mean'、
+# 'random_walk'、'roc'、'skew'、'standardized_kairi'、'std'、'std_dev'、
+# 'var'、'z_score'のいずれかで、argsは同じ名前のi_*関数の銘柄、時間足より
+# 後の引数とする。
+def add_indicator(graph, name, indicator, *args):
+    shift = args[-1]
+    close = ('price', 'close', shift)
+    change = ('change', close)
+    if indicator == 'atr':
+        keys = [('mean', ('tr', close), args[0])]
+    elif indicator == 'hl_band' or indicator == 'level':
+        keys = [close, ('max', ('price', 'high', shift), args[0]),
+                ('min', ('price', 'low', shift), args[0])]
+    elif indicator == 'kairi':
+        keys = [('kairi', close, args[0])]
+    elif indicator == 'kurt':
+        keys = [('kurt', change, args[0])]
+    elif indicator == 'ma':
+        keys = [('mean', close, args[0])]
+    elif indicator == 'mean':
+        keys = [('mean', change, args[0])]
+    elif indicator == 'random_walk':
+        keys = [close, ('lag', close, args[0]), ('var', change, args[1])]
+    elif indicator == 'roc':
+        keys = [close, ('lag', close, args[0])]
+    elif indicator == 'skew':
+        keys = [('skew', change, args[0])]
+    elif indicator == 'standardized_kairi':
+        kairi = ('kairi', close, args[0])
+        keys = [kairi, ('mean', kairi, args[1]), ('var', kairi, args[1])]
+    elif indicator == 'std' or indicator == 'var':
+        keys = [('var', change, args[0])]
+    elif indicator == 'std_dev':
+        keys = [('var', close, args[0])]
+    elif indicator == 'z_score':
+        keys = [close, ('mean', close, args[0]), ('var', close, args[0])]
+    for key in keys:
+        add_graph_node(graph, key)
+    graph['outputs'][name] = (indicator, args, keys)
+
+# 管理情報にない（他のプロセスが書いた）pklファイルを取り込み、戻り値を返す。
+# 元データが更新されていたり、エントリーを持たない古いpklファイルであれば
+# Noneを返す（呼び出し元で計算し直す）。
+def adopt_cache_entry(key, pkl_file_path):
+    payload = joblib.load(pkl_file_path)
+    if isinstance(payload, dict) == False or 'cache_data' not in payload:
+        return None
+    for path, fingerprint in payload['sources'].items():
+        if get_fingerprint(path) != fingerprint:
+            return None
+    record_cache_entry(key, payload['func'],
+                       {'sources': payload['sources'],
+                        'deps': set(payload['deps'])})
+    ret = unpack_compact(payload['cache_data'])
+    return ret
+
+# share_arrayで共有メモリーに置いた配列にアタッチする（コピーはしない）。
+def attach_array(spec):
+    name, dtype, shape = spec
+    if name not in shared_blocks:
+        # 子プロセスはresource_trackerを親プロセスと共有するので、
+        # 子プロセスの終了時に削除されることはない。
+        shared_blocks[name] = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype),
+                       buffer=shared_blocks[name].buf)
+    array.flags.writeable = False
+    return array
+
+# publish_datasetで作ったデータセットにアタッチする。
+# 以降、その銘柄、時間足のload_priceと共有したi_*関数は共有メモリーの
+# データを返す。同じデータセットに何度アタッチしてもよい。
+def attach_dataset(dataset):
+    key = (dataset['symbol'], dataset['timeframe'])
+    if shared_price.get(key, {}).get('id') == dataset['id']:
+        return
+    # キャッシュのキーを親プロセスと揃える。
+    if compact_mode != dataset['compact']:
+        set_compact_mode(dataset['compact'])
+    index = pd.DatetimeIndex(attach_array(dataset['index']).view('M8[ns]'))
+    price_index[key] = index
+    price = {'id': dataset['id'], 'sources': dataset['sources']}
+    for field, spec in dataset['price'].items():
+        price[field] = pd.Series(attach_array(spec), index=index, name=field)
+    shared_price[key] = price
+    for cache_key, entry in dataset['cache'].items():
+        values = attach_array(entry['values'])
+        if 'columns' in entry:
+            data = pd.DataFrame(values, index=index,
+                                columns=entry['columns'])
+        else:
+            data = pd.Series(values, index=index, name=entry['name'])
+        shared_cache[cache_key] = (data, entry['sources'])
+
 # バックテストを実行する。後で見直し。
+# report=1なら表と資産曲線を表示する。report=2ならmatplotlibを使わずに
+# BacktestResultを返すので、グラフは必要なときにplot_equityで描く。
+# commission、swap_long、swap_shortはcalc_pnlと同じで、最適化にも使う。
+# datasetにpublish_datasetのデータセットを渡せば、最適化とウォークフォワードの
+# 各プロセスは共有メモリーの価格と指標を使う。
 def backtest(ea, symbol, timeframe, spread, start, end, mode=1, inputs=None,
              rranges=None, min_trade=260, method='sharpe',
-             in_sample_period=365, out_of_sample_period=365, report=1):
+             in_sample_period=365, out_of_sample_period=365, report=1,
+             n_jobs=1, fold_jobs=1, slpips=None, tppips=None, commission=0.0,
+             swap_long=0.0, swap_short=0.0, dataset=None):
     t1 = time.time()
-    start_dt = datetime.strptime(start + ' 00:00', '%Y-%m-%d %H:%M')
-    end_dt = datetime.strptime(end + ' 23:59', '%Y-%m-%d %H:%M')
-    table =  pd.DataFrame()
-    if mode == 1:
-        buy_entry, buy_exit, sell_entry, sell_exit = ea(
-                inputs, symbol, timeframe)
-        buy_position, sell_position = calc_position(
-                buy_entry, buy_exit, sell_entry, sell_exit)
-        buy_position = buy_position[start:end]
-        sell_position = sell_position[start:end]
-        trade = calc_trade(buy_position, sell_position, start, end) 
-        pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread)
-        if report == 1:
-            apr = calc_apr(pnl, start, end)
-            sharpe = calc_sharpe(pnl, timeframe, start, end)
-            drawdown = calc_drawdown(pnl, start, end)
-            r2 = calc_r2(pnl, start, end)
-            table.loc[0, 'symbol'] = symbol
-            table.loc[0, 'tf'] = str(timeframe)
-            table.loc[0, 'start'] = start
-            table.loc[0, 'end'] = end
-            table.loc[0, 'trade'] = str(trade)
-            table.loc[0, 'apr'] = str(np.round(apr, 2))
-            table.loc[0, 'sr'] = str(np.round(sharpe, 2))
-            table.loc[0, 'dd'] = str(np.round(drawdown, 2))
-            table.loc[0, 'r2'] = str(np.round(r2, 2))
-            if inputs is not None:
-                table.loc[0, 'inputs'] = str(np.round(inputs, 2))
-            table = table.dropna(axis=1)
-            pd.set_option('display.max_columns', 100)
-            pd.set_option('display.width', 1000)
-            print(table)
-            equity = pnl[start:end].cumsum()
-            ax=plt.subplot()
-            ax.set_xticklabels(equity.index, rotation=45)
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-            plt.plot(equity)
-            plt.title('Backtest')
-            plt.xlabel('Date')
-            plt.ylabel('Equith Curve')
-            plt.tight_layout()
-            plt.savefig('backtest.png', dpi=150)
-            plt.show()
-            plt.close()
-    elif mode == 2:
-        inputs = optimize_inputs(ea, symbol, timeframe, spread, start, end,
-                                 min_trade, method, rranges)
+    rows = []
+    if mode == 1 or mode == 2:
+        if mode == 2:
+            inputs = optimize_inputs(
+                    ea, symbol, timeframe, spread, start, end, min_trade,
+                    method, rranges, n_jobs, slpips, tppips, dataset,
+                    commission, swap_long, swap_short)
         buy_entry, buy_exit, sell_entry, sell_exit = ea(
                 inputs, symbol, timeframe)
-        buy_position, sell_position = calc_position(
-                buy_entry, buy_exit, sell_entry, sell_exit)
+        exit_price = None
+        if slpips is None and tppips is None:
+            buy_position, sell_position = calc_position(
+                    buy_entry, buy_exit, sell_entry, sell_exit)
+        else:
+            buy_position, sell_position, exit_price = (
+                    calc_position_with_stop(
+                            buy_entry, buy_exit, sell_entry, sell_exit,
+                            symbol, timeframe, slpips, tppips))
+            exit_price = exit_price[start:end]
         buy_position = buy_position[start:end]
         sell_position = sell_position[start:end]
-        trade = calc_trade(buy_position, sell_position, start, end) 
-        pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread)
-        if report == 1:
-            apr = calc_apr(pnl, start, end)
-            sharpe = calc_sharpe(pnl, timeframe, start, end)
-            drawdown = calc_drawdown(pnl, start, end)
-            r2 = calc_r2(pnl, start, end)
-            table.loc[0, 'symbol'] = symbol
-            table.loc[0, 'tf'] = str(timeframe)
-            table.loc[0, 'start'] = start
-            table.loc[0, 'end'] = end
-            table.loc[0, 'trade'] = str(trade)
-            table.loc[0, 'apr'] = str(np.round(apr, 2))
-            table.loc[0, 'sr'] = str(np.round(sharpe, 2))
-            table.loc[0, 'dd'] = str(np.round(drawdown, 2))
-            table.loc[0, 'r2'] = str(np.round(r2, 2))
-            if inputs is not None:
-                table.loc[0, 'inputs'] = str(np.round(inputs, 2))
-            table = table.dropna(axis=1)
-            pd.set_option('display.max_columns', 100)
-            pd.set_option('display.width', 1000)
-            print(table)
-            equity = pnl[start:end].cumsum()
-            ax=plt.subplot()
-            ax.set_xticklabels(equity.index, rotation=45)
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-            plt.plot(equity)
-            plt.title('Backtest')
-            plt.xlabel('Date')
-            plt.ylabel('Equith Curve')
-            plt.tight_layout()  #
-            plt.savefig('backtest.png', dpi=150)
-            plt.show()
-            plt.close()
+        pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread,
+                       exit_price, commission, swap_long, swap_short)
+        start_all, end_all = start, end
+        if report == 1 or report == 2:
+            metrics = calc_metrics(pnl, timeframe, start, end, buy_position,
+                                   sell_position, exit_price)
+            rows.append({'symbol': symbol, 'tf': str(timeframe),
+                         'start': start, 'end': end, 'trade': metrics.trade,
+                         'apr': metrics.apr, 'sr': metrics.sharpe,
+                         'dd': metrics.drawdown, 'r2': metrics.r2,
+                         'inputs': inputs})
     elif mode == 3:
-        end_test_dt = start_dt
-        i = 0
-        while True:
-            start_train_dt = start_dt + timedelta(
-                days=-in_sample_period+out_of_sample_period*i)
-            end_train_dt = (start_train_dt + timedelta(days=in_sample_period)
-                - timedelta(minutes=timeframe))
-            start_test_dt = end_train_dt + timedelta(minutes=timeframe)
-            if i == 0:
-                start_all_dt = start_test_dt
-            if (start_test_dt + timedelta(days=out_of_sample_period)
-                - timedelta(minutes=timeframe)) > end_dt:
-                end_all_dt = end_test_dt
-                break
-            end_test_dt = (
-                start_test_dt + timedelta(days=out_of_sample_period)
-                - timedelta(minutes=timeframe))
-            start_train = str(start_train_dt)
-            end_train = str(end_train_dt)
-            start_test = str(start_test_dt)
-            end_test = str(end_test_dt)
-            inputs = optimize_inputs(
-                    ea, symbol, timeframe, spread, start_train, end_train,
-                    min_trade, method, rranges)
-            buy_entry, buy_exit, sell_entry, sell_exit = ea(
-                    inputs, symbol, timeframe)
-            buy_position, sell_position = calc_position(
-                    buy_entry, buy_exit, sell_entry,
-                    sell_exit)
-            buy_position = buy_position[start_test:end_test]
-            sell_position = sell_position[start_test:end_test]
-            trade_temp = calc_trade(
-                    buy_position, sell_position, start_test, end_test) 
-            pnl_temp = calc_pnl(
-                    buy_position, sell_position, symbol, timeframe, spread)
-            if i == 0:
-                pnl = pnl_temp[start_test:end_test]
-                trade = trade_temp
-            else:
-                pnl = pnl.append(pnl_temp[start_test:end_test])
-                trade += trade_temp
-            if report == 1:
-                apr = calc_apr(pnl_temp, start_test, end_test)
-                sharpe = calc_sharpe(pnl_temp, timeframe, start_test, end_test)
-                drawdown = calc_drawdown(pnl_temp, start_test, end_test)
-                r2 = calc_r2(pnl_temp, start_test, end_test)
-                table.loc[i, 'symbol'] = symbol
-                table.loc[i, 'tf'] = str(timeframe)
-                table.loc[i, 'start'] = start_test[:10]
-                table.loc[i, 'end'] = end_test[:10]
-                table.loc[i, 'trade'] = str(trade_temp)
-                table.loc[i, 'apr'] = str(np.round(apr, 2))
-                table.loc[i, 'sr'] = str(np.round(sharpe, 2))
-                table.loc[i, 'dd'] = str(np.round(drawdown, 2))
-                table.loc[i, 'r2'] = str(np.round(r2, 2))
-                table.loc[i, 'inputs'] = str(np.round(inputs, 2))
-            del buy_position
-            del sell_position
-            del pnl_temp
-            gc.collect()
-            i += 1
-        if report == 1:
-            start_all = str(start_all_dt)
-            end_all = str(end_all_dt)
-            apr = calc_apr(pnl, start_all, end_all)
-            sharpe = calc_sharpe(pnl, timeframe, start_all, end_all)
-            drawdown = calc_drawdown(pnl, start_all, end_all)
-            r2 = calc_r2(pnl, start_all, end_all)
-            table.loc[i, 'symbol'] = symbol
-            table.loc[i, 'tf'] = str(timeframe)
-            table.loc[i, 'start'] = start_all[:10]
-            table.loc[i, 'end'] = end_all[:10]
-            table.loc[i, 'trade'] = str(trade)
-            table.loc[i, 'apr'] = str(np.round(apr, 2))
-            table.loc[i, 'sr'] = str(np.round(sharpe, 2))
-            table.loc[i, 'dd'] = str(np.round(drawdown, 2))
-            table.loc[i, 'r2'] = str(np.round(r2, 2))
-            table.loc[i, 'inputs'] = ''
-            table = table.iloc[0:i+1, :]
-            table = table.dropna(axis=1)
-            pd.set_option('display.max_columns', 100)
-            pd.set_option('display.width', 1000)
-            print(table)
-            equity = pnl[start_all:end_all].cumsum()
-            ax=plt.subplot()
-            ax.set_xticklabels(equity.index, rotation=45)
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-            plt.plot(equity)
-            plt.title('Backtest')
-            plt.xlabel('Date')
-            plt.ylabel('Equity Curve')
-            plt.tight_layout()
-            plt.savefig('backtest.png', dpi=150)
-            plt.show()
-            plt.close()
+        # 各フォールドは最後に結合するまで独立しているので、
+        # 期間を先に決めておき、fold_jobsのプロセスで並列に実行する。
+        folds, start_all, end_all = plan_walk_forward(
+                start, end, timeframe, in_sample_period,
+                out_of_sample_period)
+        # 各プロセスが同時に変換し直さないように、価格データは先に読んでおく。
+        if dataset is None:
+            load_price(symbol, timeframe, 'close')
+        results = joblib.Parallel(n_jobs=fold_jobs)(
+                joblib.delayed(run_walk_forward_fold)(
+                        ea, symbol, timeframe, spread, fold, min_trade,
+                        method, rranges, n_jobs, slpips, tppips, commission,
+                        swap_long, swap_short, dataset)
+                for fold in folds)
+        # 結果はフォールドの順番どおりに返ってくる。
+        pnl = pd.concat([result[2] for result in results])
+        trade = sum([result[1] for result in results])
+        inputs = [result[0] for result in results]
+        if report == 1 or report == 2:
+            for i in range(len(folds)):
+                start_test, end_test = folds[i][2], folds[i][3]
+                inputs_temp, trade_temp, pnl_temp = results[i]
+                metrics = calc_metrics(pnl_temp, timeframe, start_test,
+                                       end_test)
+                rows.append({'symbol': symbol, 'tf': str(timeframe),
+                             'start': start_test[:10], 'end': end_test[:10],
+                             'trade': trade_temp, 'apr': metrics.apr,
+                             'sr': metrics.sharpe, 'dd': metrics.drawdown,
+                             'r2': metrics.r2, 'inputs': inputs_temp})
+            metrics = calc_metrics(pnl, timeframe, start_all, end_all)
+            metrics = metrics._replace(trade=trade)
+            rows.append({'symbol': symbol, 'tf': str(timeframe),
+                         'start': start_all[:10], 'end': end_all[:10],
+                         'trade': trade, 'apr': metrics.apr,
+                         'sr': metrics.sharpe, 'dd': metrics.drawdown,
+                         'r2': metrics.r2, 'inputs': None})
+    if report == 1 or report == 2:
+        table = pd.DataFrame(rows)
+        equity = pnl[start_all:end_all].cumsum()
     if report == 1:
+        print_table(table)
+        plot_equity(equity, show=1)
         t2 = time.time()
         m = np.floor((t2-t1)/60)
         s = t2-t1-m*60
         m = int(m)
         s = int(s)
         print('所要時間は'+str(m)+'分'+str(s)+'秒です。')
+    elif report == 2:
+        result = BacktestResult(metrics, table, equity, pnl, inputs)
+        return result
     return pnl
 
+# 複数のパラメータセットをまとめてバックテストする。
+# シグナルはパラメータセットごとに1列のDataFrameで渡す。
+# ポジション、トレード数、損益、各指標を列方向にまとめて計算する。
+def backtest_batch(buy_entry, buy_exit, sell_entry, sell_exit, symbol,
+                   timeframe, spread, start, end):
+    buy_position, sell_position = calc_position_batch(
+            buy_entry, buy_exit, sell_entry, sell_exit)
+    buy_position = buy_position[start:end]
+    sell_position = sell_position[start:end]
+    trade = calc_trade_batch(buy_position, sell_position, start, end)
+    pnl = calc_pnl_batch(buy_position, sell_position, symbol, timeframe,
+                         spread)
+    table = pd.DataFrame(index=pnl.columns)
+    table['trade'] = trade
+    table['apr'] = calc_apr_batch(pnl, start, end)
+    table['sr'] = calc_sharpe_batch(pnl, timeframe, start, end)
+    table['dd'] = calc_drawdown_batch(pnl, start, end)
+    table['r2'] = calc_r2_batch(pnl, start, end)
+    return table, pnl
+
 # 機械学習用のバックテストを実行する。
 # 今のままでは使えないので後日手直し。
+# reportの使い方はbacktestと同じ（report=0なら何も表示しない）。
 def backtest_ml(ea, symbol, timeframe, spread, start, end, get_model,
-                in_sample_period, out_of_sample_period):
+                in_sample_period, out_of_sample_period, report=1):
     start = datetime.strptime(start + ' 00:00', '%Y.%m.%d %H:%M')
     end = datetime.strptime(end + ' 00:00', '%Y.%m.%d %H:%M')
     end -= timedelta(minutes=timeframe)
     inputs = None
-    report =  pd.DataFrame(
-            index=[['']*1000], columns=['start_test', 'end_test', 'trade',
-                  'apr', 'sharpe', 'drawdown'])
+    rows = []
     end_test = start
+    # アウトオブサンプルの損益はリストに集めて、最後に1回だけ結合する。
+    pnl_folds = []
     i = 0
     while True:
         start_train = start + timedelta(days=out_of_sample_period*i)
@@ -266,48 +389,171 @@ def backtest_ml(ea, symbol, timeframe, spread, start, end, get_model,
         apr = calc_apr(pnl_all, start_test, end_test)
         sharpe = calc_sharpe(pnl_all, timeframe, start_test, end_test)
         drawdown = calc_drawdown(pnl_all, start_test, end_test)
-        report.iloc[i, 0] = start_test.strftime('%Y.%m.%d')
-        report.iloc[i, 1] = end_test.strftime('%Y.%m.%d')
-        report.iloc[i, 2] = str(trade)
-        report.iloc[i, 3] = str(np.round(apr, 2))
-        report.iloc[i, 4] = str(np.round(sharpe, 2))
-        report.iloc[i, 5] = str(np.round(drawdown, 2))
+        rows.append({'start_test': start_test.strftime('%Y.%m.%d'),
+                     'end_test': end_test.strftime('%Y.%m.%d'),
+                     'trade': trade, 'apr': apr, 'sharpe': sharpe,
+                     'drawdown': drawdown})
+        pnl_folds.append(pnl_all[start_test:end_test])
         if i == 0:
-            temp = pnl_all[start_test:end_test]
             trade_all_all = trade_all
         else:
-            temp = temp.append(pnl_all[start_test:end_test])
             trade_all_all += trade_all
         i += 1
-    pnl_all = temp
+    pnl_all = pd.concat(pnl_folds)
     apr = calc_apr(pnl_all, start_all, end_all)
     sharpe = calc_sharpe(pnl_all, timeframe, start_all, end_all)
     drawdown = calc_drawdown(pnl_all, start_all, end_all)
-    report.iloc[i, 0] = start_all.strftime('%Y.%m.%d')
-    report.iloc[i, 1] = end_all.strftime('%Y.%m.%d')
-    report.iloc[i, 2] = str(trade)
-    report.iloc[i, 3] = str(np.round(apr, 2))
-    report.iloc[i, 4] = str(np.round(sharpe, 2))
-    report.iloc[i, 5] = str(np.round(drawdown, 2))
-    report = report.iloc[0:i+1, :]
-    report = report.dropna(axis=1)
-    pd.set_option('display.max_columns', 100)
-    pd.set_option('display.width', 1000)
-    print(report)
+    rows.append({'start_test': start_all.strftime('%Y.%m.%d'),
+                 'end_test': end_all.strftime('%Y.%m.%d'), 'trade': trade,
+                 'apr': apr, 'sharpe': sharpe, 'drawdown': drawdown})
+    table = pd.DataFrame(rows)
     equity = (1.0+pnl_all).cumprod() - 1.0
-    ax=plt.subplot()
-    ax.set_xticklabels(equity.index, rotation=45)
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-    plt.plot(equity)
-    plt.title('Backtest')
-    plt.xlabel('Date')
-    plt.ylabel('Equity Curve')
-    plt.tight_layout()
-    plt.savefig('backtest.png', dpi=150)
-    plt.show()
-    plt.close()
+    if report == 1:
+        print_table(table)
+        plot_equity(equity, show=1)
+    elif report == 2:
+        metrics = Metrics(apr, sharpe, drawdown, None, trade, None, None)
+        result = BacktestResult(metrics, table, equity, pnl_all, None)
+        return result
     return pnl_all
 
+# 複数の通貨ペアのポートフォリオをまとめてバックテストする。
+# シグナルと始値を共通の時間インデックスにそろえ、ポジション、コスト、損益を
+# （足×通貨ペア）の2次元配列で一度に計算する。
+# spreadsは通貨ペアごとのスプレッドで、calc_pnlと同じく一定の値か足ごとの
+# Series（calc_costで計算する）。
+# weightsは通貨ペアごとの損益に掛ける重みで、省略すると1（損益の合計）。
+# 戻り値の表は通貨ペアごとの成績（重みを掛けた損益）で、最後の行が
+# ポートフォリオ全体の成績。損益は重みを掛けた通貨ペアごとのDataFrame。
+def backtest_portfolio(ea, inputs, symbols, timeframe, spreads, start, end,
+                       weights=None):
+    if weights is None:
+        weights = np.ones(len(symbols))
+    weights = np.asarray(weights, dtype=float)
+    signals = [ea(inputs, symbol, timeframe) for symbol in symbols]
+    # 足がない通貨ペアはシグナルなし、価格は前の足と同じとみなす。
+    index = signals[0][0].index
+    for signal in signals[1:]:
+        if signal[0].index.equals(index) == False:
+            index = index.union(signal[0].index)
+    buy_entry, buy_exit, sell_entry, sell_exit = [
+            pd.DataFrame(
+                    {symbols[j]: signals[j][k].reindex(index,
+                                                       fill_value=False)
+                     for j in range(len(symbols))}, index=index)
+            for k in range(4)]
+    buy_position, sell_position = calc_position_batch(
+            buy_entry, buy_exit, sell_entry, sell_exit)
+    buy_position = buy_position[start:end]
+    sell_position = sell_position[start:end]
+    trade = calc_trade_batch(buy_position, sell_position, start, end)
+    op = pd.DataFrame(
+            {symbol: i_open(symbol, timeframe, 0) for symbol in symbols})
+    op = op.reindex(index).ffill()
+    cost = pd.DataFrame(
+            {symbol: calc_cost(op[symbol], get_pip(op[symbol].dropna(),
+                                                   symbol), spread)
+             for symbol, spread in zip(symbols, spreads)}, index=op.index)
+    change = ((op.shift(-1)-op)/op).reindex(buy_position.index).values
+    cost = cost.reindex(buy_position.index).values
+    buy = buy_position.values
+    sell = sell_position.values
+    entry_point = (calc_entry_point(buy, 1.0).astype(int)
+                   + calc_entry_point(sell, -1.0).astype(int))
+    pnl = (change*(buy+sell) - entry_point*cost) * weights
+    pnl[np.isnan(pnl)] = 0.0
+    pnl = pd.DataFrame(pnl, index=buy_position.index, columns=symbols)
+    table = pd.DataFrame(index=symbols)
+    table['weight'] = weights
+    table['trade'] = trade
+    table['apr'] = calc_apr_batch(pnl, start, end)
+    table['sr'] = calc_sharpe_batch(pnl, timeframe, start, end)
+    table['dd'] = calc_drawdown_batch(pnl, start, end)
+    table['r2'] = calc_r2_batch(pnl, start, end)
+    metrics = calc_metrics(pnl.sum(axis=1), timeframe, start, end)
+    table.loc['portfolio'] = [weights.sum(), trade.sum(), metrics.apr,
+                              metrics.sharpe, metrics.drawdown, metrics.r2]
+    table['trade'] = table['trade'].astype(int)
+    return table, pnl
+
+# i_*関数の戻り値をtempフォルダーにpklファイルとしてキャッシュするデコレーター。
+# キーは関数名と引数から作るので、スタックを調べる必要はない。
+# pklファイルを読む前にメモリー上のキャッシュを確認する。
+# 元データが更新されたエントリーは使わずに計算し直す。
+def cache_pkl(func):
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # コンパクトモードでは別のエントリーとする。
+        func_name = func.__name__
+        if compact_mode == 1:
+            func_name += '_f32'
+        pkl_file_path = get_cache_file_path(func_name, signature, args,
+                                            kwargs)
+        key = os.path.basename(pkl_file_path)
+        ret = None
+        # 共有メモリーにあればそれを使う。
+        if key in shared_cache:
+            ret, sources = shared_cache[key]
+            if len(cache_stack) > 0:
+                cache_stack[-1]['deps'].add(key)
+                cache_stack[-1]['sources'].update(sources)
+            return ret
+        if check_cache_entry(key) == True:
+            ret = restore_memory(pkl_file_path)
+            if ret is None:
+                ret = restore_pkl(pkl_file_path)
+                if ret is None:
+                    cache_manifest_info['disk_misses'] += 1
+                else:
+                    cache_manifest_info['disk_hits'] += 1
+                    save_memory(ret, pkl_file_path)
+        elif os.path.exists(pkl_file_path) == True:
+            # 他のプロセスが書いたpklファイルなら管理情報に取り込んで使う。
+            ret = adopt_cache_entry(key, pkl_file_path)
+            if ret is not None:
+                cache_manifest_info['disk_hits'] += 1
+                save_memory(ret, pkl_file_path)
+        if ret is None:
+            cache_stack.append({'sources': {}, 'deps': set()})
+            try:
+                ret = func(*args, **kwargs)
+            finally:
+                frame = cache_stack.pop()
+            if compact_mode == 1:
+                ret = to_float32(ret)
+            save_pkl(ret, pkl_file_path, func.__name__, frame)
+            save_memory(ret, pkl_file_path)
+            record_cache_entry(key, func.__name__, frame)
+        # 呼び出し元のi_*関数にも元データと依存関係を伝える。
+        if len(cache_stack) > 0:
+            cache_stack[-1]['deps'].add(key)
+            cache_stack[-1]['sources'].update(
+                    get_manifest()[key]['sources'])
+        return ret
+    return wrapper
+
+# キャッシュの状況を返す。
+def cache_stats():
+    manifest = get_manifest()
+    stats = {}
+    stats['entries'] = len(manifest)
+    stats['bytes'] = sum([entry['bytes'] for entry in manifest.values()])
+    stats['max_bytes'] = cache_manifest_info['max_bytes']
+    stats['disk_hits'] = cache_manifest_info['disk_hits']
+    stats['disk_misses'] = cache_manifest_info['disk_misses']
+    stats['invalidated'] = cache_manifest_info['invalidated']
+    stats['evicted'] = cache_manifest_info['evicted']
+    stats['memory_entries'] = len(memory_cache)
+    stats['memory_bytes'] = memory_cache_info['bytes']
+    stats['memory_hits'] = memory_cache_info['hits']
+    stats['memory_misses'] = memory_cache_info['misses']
+    by_func = pd.DataFrame(
+            [(entry['func'], entry['bytes']) for entry in manifest.values()],
+            columns=['func', 'bytes'])
+    stats['by_func'] = by_func.groupby('func')['bytes'].agg(['count', 'sum'])
+    return stats
+
 # 年利率（annual profit rate）を計算する。
 # 複利にはしていない。
 def calc_apr(pnl, start, end):
@@ -317,12 +563,124 @@ def calc_apr(pnl, start, end):
     apr = cum_pnl.iloc[len(cum_pnl)-1] / year
     return apr
 
+# 年利率を列ごとにまとめて計算する。
+def calc_apr_batch(pnl, start, end):
+    cum_pnl = pnl[start:end].values.sum(axis=0)
+    start_dt, end_dt = to_datetime(start, end)
+    year = ((end_dt-start_dt).total_seconds()+60*60*24) / (60*60*24*365)
+    apr = cum_pnl / year
+    return apr
+
+# 直近period本の最大値から何本経過したかを計算する。
+# period - 1 - argmaxと同じ結果（同値なら古い方）をO(n)で求める。
+# period本ごとのブロック内で前からの累積最大と後ろからの累積最大を求め、
+# 各ウィンドウを前のブロックの後ろ側と後のブロックの前側に分けて合わせる。
+def calc_bars_since_max(values, period):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    ret = np.full(n, np.nan)
+    if period < 1 or n < period:
+        return ret
+    m = -(-n//period) * period
+    a = np.full(m, -np.inf)
+    a[:n] = np.where(np.isnan(x), -np.inf, x)
+    a = a.reshape(-1, period)
+    j = np.arange(period)
+    base = (np.arange(len(a))*period)[:, None]
+    # ブロックの先頭からの累積最大と、その最初の位置。
+    prefix_max = np.maximum.accumulate(a, axis=1)
+    new = np.ones(a.shape, dtype=bool)
+    new[:, 1:] = a[:, 1:] > prefix_max[:, :-1]
+    prefix_arg = np.maximum.accumulate(np.where(new, j, 0), axis=1) + base
+    # ブロックの末尾からの累積最大と、その最初の位置。
+    b = a[:, ::-1]
+    suffix_max = np.maximum.accumulate(b, axis=1)
+    new = np.ones(b.shape, dtype=bool)
+    new[:, 1:] = b[:, 1:] >= suffix_max[:, :-1]
+    suffix_arg = np.maximum.accumulate(np.where(new, j, 0), axis=1)
+    suffix_arg = (period-1-suffix_arg)[:, ::-1] + base
+    suffix_max = suffix_max[:, ::-1]
+    prefix_max = prefix_max.ravel()
+    prefix_arg = prefix_arg.ravel()
+    suffix_max = suffix_max.ravel()
+    suffix_arg = suffix_arg.ravel()
+    end = np.arange(period-1, n)
+    start = end - period + 1
+    arg = np.where(suffix_max[start]>=prefix_max[end], suffix_arg[start],
+                   prefix_arg[end])
+    ret[period-1:] = end - arg
+    # rolling().apply()と同じく、NaNを含むウィンドウはNaNとする。
+    count = np.concatenate([[0], np.cumsum(np.isnan(x))])
+    ret[period-1:][(count[period:]-count[:-period])>0] = np.nan
+    return ret
+
+# エントリーした足で差し引くコスト（価格に対する比率）を足ごとに求める。
+# spreadは一定の値か足ごとのSeriesで、commissionとともにpipsで指定する。
+# Seriesは価格の足にそろえて前の値で埋め、最初の値より前の足は最初の値とする。
+def calc_cost(op, pip, spread, commission=0.0):
+    if isinstance(spread, pd.Series):
+        spread = spread.reindex(op.index).ffill().bfill()
+    cost = (spread+commission) * pip / op
+    return cost
+
 # 最大ドローダウン（％）を計算する。
 def calc_drawdown(pnl, start, end):
     equity = pnl[start:end].cumsum()
     drawdown = (equity.cummax()-equity).max()
     return drawdown
 
+# 最大ドローダウンを列ごとにまとめて計算する。
+def calc_drawdown_batch(pnl, start, end):
+    equity = np.cumsum(pnl[start:end].values, axis=0)
+    drawdown = (np.maximum.accumulate(equity, axis=0)-equity).max(axis=0)
+    return drawdown
+
+# ポジションを持ったタイミングを返す（1本前がノーポジションの足）。
+def calc_entry_point(position, side):
+    entry_point = np.zeros(position.shape, dtype=bool)
+    entry_point[1:] = (position[1:]==side) & (position[:-1]==0.0)
+    return entry_point
+
+# 計算グラフのノードを依存するノードの値から計算する。
+def calc_graph_node(graph, key, values):
+    kind = key[0]
+    deps = [values[dep] for dep in graph['nodes'][key]]
+    if kind == 'price':
+        func = {'open': i_open, 'high': i_high, 'low': i_low,
+                'close': i_close, 'volume': i_volume}[key[1]]
+        ret = func(graph['symbol'], graph['timeframe'], key[2])
+    elif kind == 'lag':
+        ret = deps[0].shift(key[2])
+    elif kind == 'change':
+        ret = (deps[0]-deps[1]) / deps[1]
+    elif kind == 'tr':
+        high, low, prev_close = deps
+        temp = high - low
+        temp = pd.concat([temp, high - prev_close], axis=1)
+        temp = pd.concat([temp, prev_close - low], axis=1)
+        ret = temp.max(axis=1)
+    elif kind == 'kairi':
+        ret = (deps[0]-deps[1]) / deps[1] * 100.0
+    elif kind == 'sums':
+        ret = {}
+    elif kind == 'window':
+        variance = int(('var', key[1], key[2]) in graph['nodes'])
+        ret = calc_rolling_window(deps[0].values, key[2], deps[1],
+                                  variance=variance)
+    elif kind == 'mean':
+        ret = pd.Series(deps[1][0], index=deps[0].index)
+    elif kind == 'var':
+        ret = pd.Series(deps[1][1], index=deps[0].index)
+    elif kind == 'max':
+        ret = deps[0].rolling(window=key[2]).max()
+    elif kind == 'min':
+        ret = deps[0].rolling(window=key[2]).min()
+    elif kind == 'skew':
+        ret = deps[0].rolling(window=key[2]).skew()
+    elif kind == 'kurt':
+        ret = deps[0].rolling(window=key[2]).kurt()
+    return ret
+
 # 尖度を計算する。
 def calc_kurt(pnl, start, end):
     pnl[pnl==0.0] = np.nan
@@ -330,32 +688,159 @@ def calc_kurt(pnl, start, end):
     kurt = pnl.kurt()
     return kurt
 
+# 年利率、シャープレシオ、最大ドローダウン、R^2、トレード数、歪度、尖度を
+# まとめて計算し、Metricsで返す。
+# 損益の配列を1回だけ取り出して使い回し、R^2は閉じた式で求める。
+# ポジションを渡さなければトレード数はNoneとする。
+# 歪度、尖度はcalc_skew、calc_kurtと同じく損益が0の足を除いて計算する。
+def calc_metrics(pnl, timeframe, start, end, buy_position=None,
+                 sell_position=None, exit_price=None):
+    # 文字列の期間でのスライスは遅いので、位置を1回だけ求めて使い回す。
+    no = pnl.index.slice_indexer(start, end)
+    values = pnl.values[no]
+    n = len(values)
+    # 期間に足がない（週末だけなど）場合は損益がなかったものとする。
+    if n == 0:
+        trade = None
+        if buy_position is not None and sell_position is not None:
+            trade = 0
+        metrics = Metrics(0.0, 0.0, 0.0, 0.0, trade, np.nan, np.nan)
+        return metrics
+    equity = np.cumsum(values)
+    # 年利率
+    start_dt, end_dt = to_datetime(start, end)
+    year = ((end_dt-start_dt).total_seconds()+60*60*24) / (60*60*24*365)
+    apr = equity[n-1] / year
+    # シャープレシオ（pandasのmean、stdと同じ順序で計算する）
+    mean = values.sum() / n
+    std = np.sqrt(((mean-values)**2).sum() / (n-1))
+    if std > eps:
+        sharpe = mean / std * np.sqrt(260*1440/timeframe)
+    else:
+        sharpe = 0.0
+    # 最大ドローダウン
+    drawdown = (np.maximum.accumulate(equity)-equity).max()
+    # R^2（直線回帰のR^2は相関係数の2乗に等しい）
+    x = np.arange(n, dtype=float)
+    x -= x.mean()
+    y = equity - equity.mean()
+    syy = (y*y).sum()
+    if syy > 0.0:
+        r2 = (x*y).sum()**2 / ((x*x).sum()*syy)
+    else:
+        r2 = 1.0
+    # トレード数
+    trade = None
+    if buy_position is not None and sell_position is not None:
+        first = pnl.index[no][0]
+        last = pnl.index[no][n-1]
+        buy = buy_position[first:last].values.astype(float)
+        sell = sell_position[first:last].values.astype(float)
+        buy_entry_point = calc_entry_point(buy, 1.0)
+        sell_entry_point = calc_entry_point(sell, -1.0)
+        if exit_price is not None:
+            exited = np.zeros(len(buy), dtype=bool)
+            exited[1:] = ~np.isnan(exit_price[first:last].values[:-1])
+            buy_entry_point |= (buy==1.0) & exited
+            sell_entry_point |= (sell==-1.0) & exited
+        trade = (buy_entry_point.astype(int).sum()
+                 + sell_entry_point.astype(int).sum())
+    # 歪度、尖度（pandasのskew、kurtと同じ不偏推定量）
+    values = values[values!=0.0]
+    count = len(values)
+    skew = np.nan
+    kurt = np.nan
+    if count >= 3:
+        adjusted = values - values.sum()/count
+        adjusted2 = adjusted**2
+        m2 = adjusted2.sum()
+        m3 = (adjusted2*adjusted).sum()
+        m4 = (adjusted2**2).sum()
+        # pandasと同じく、浮動小数点の誤差は0とみなす。
+        m3 = 0.0 if np.abs(m3) < 1e-14 else m3
+        if np.abs(m2) < 1e-14:
+            skew = 0.0
+        else:
+            skew = (count * (count-1)**0.5 / (count-2)) * (m3 / m2**1.5)
+    if count >= 4:
+        numerator = count * (count+1) * (count-1) * m4
+        denominator = (count-2) * (count-3) * m2**2
+        numerator = 0.0 if np.abs(numerator) < 1e-14 else numerator
+        denominator = 0.0 if np.abs(denominator) < 1e-14 else denominator
+        if denominator == 0.0:
+            kurt = 0.0
+        else:
+            adj = 3 * (count-1)**2 / ((count-2)*(count-3))
+            kurt = numerator / denominator - adj
+    metrics = Metrics(apr, sharpe, drawdown, r2, trade, skew, kurt)
+    return metrics
+
 # 損益を計算する。
 # コストはポジションを持ったタイミングで発生したと考える。
-def calc_pnl(buy_position, sell_position, symbol, timeframe, spread):
+# exit_priceはcalc_position_with_stopの決済価格（ポジションと同じ期間）。
+# spreadは一定の値か足ごとのSeries（calc_spread_profileなど）で、
+# commission（1回の取引の手数料）とともにpipsで指定し、エントリーした足で
+# 差し引く。swap_long、swap_shortは1日あたりのスワップポイント（pips）で、
+# 日付をまたいでポジションを持ち越した日数分を加える。
+def calc_pnl(buy_position, sell_position, symbol, timeframe, spread,
+             exit_price=None, commission=0.0, swap_long=0.0, swap_short=0.0):
     op = i_open(symbol, timeframe, 0)
+    # コンパクトモードのfloat32の価格でも損益はfloat64で計算する。
+    if op.dtype != np.float64:
+        op = op.astype(np.float64)
     # 通貨ペアによってスプレッドを調整する。
-    if op[len(op)-1] >= 1000.0:  # 例えばUS500で6.0pisなら6.0ドル。
-        adj_spread = spread
-    elif op[len(op)-1] >= 5.0:  # 例えばUSDJPYで0.4pisなら0.004円。
-        adj_spread = spread / 100.0
-    else:  # 例えばEURUSDで0.5pisなら0.00005ドル。
-        adj_spread = spread / 10000.0
+    pip = get_pip(op, symbol)
+    cost = calc_cost(op, pip, spread, commission)
     # 買いポジションのコストを求める。
     buy_entry_point = (buy_position==1.0) & (buy_position.shift(1)==0.0)
-    buy_entry_point = buy_entry_point.astype(int)
-    buy_cost = buy_entry_point * (adj_spread/op)
     # 売りポジションのコストを求める。
     sell_entry_point = (sell_position==-1.0) & (sell_position.shift(1)==0.0)
+    change = op.shift(-1) - op
+    if exit_price is not None:
+        # 損切り、利食いの次の足で入り直した場合もエントリーとみなす。
+        exited = exit_price.shift(1).notna()
+        buy_entry_point = buy_entry_point | ((buy_position==1.0) & exited)
+        sell_entry_point = sell_entry_point | ((sell_position==-1.0) & exited)
+        # 損切り、利食いの足は決済価格までの値動きで損益を計算する。
+        exit_price = exit_price.dropna()
+        change[exit_price.index] = exit_price - op[exit_price.index]
+    buy_entry_point = buy_entry_point.astype(int)
+    buy_cost = buy_entry_point * cost
     sell_entry_point = sell_entry_point.astype(int)
-    sell_cost = sell_entry_point * (adj_spread/op)
+    sell_cost = sell_entry_point * cost
     # 損益を計算する。
-    buy_pnl = (op.shift(-1)-op) / op * buy_position - buy_cost
-    sell_pnl = (op.shift(-1)-op) / op * sell_position - sell_cost
+    buy_pnl = change / op * buy_position - buy_cost
+    sell_pnl = change / op * sell_position - sell_cost
+    if swap_long != 0.0 or swap_short != 0.0:
+        rollover = calc_rollover(op.index) * pip / op
+        buy_pnl = buy_pnl + buy_position * swap_long * rollover
+        sell_pnl = sell_pnl - sell_position * swap_short * rollover
     pnl = buy_pnl + sell_pnl
     pnl = pnl.fillna(0.0)
     return pnl
 
+# 損益を列ごとにまとめて計算する（コストの指定はcalc_pnlと同じ）。
+def calc_pnl_batch(buy_position, sell_position, symbol, timeframe, spread,
+                   commission=0.0, swap_long=0.0, swap_short=0.0):
+    op = i_open(symbol, timeframe, 0)
+    if op.dtype != np.float64:
+        op = op.astype(np.float64)
+    pip = get_pip(op, symbol)
+    index = buy_position.index
+    change = ((op.shift(-1)-op)/op).reindex(index).values
+    cost = calc_cost(op, pip, spread, commission).reindex(index).values
+    buy = buy_position.values
+    sell = sell_position.values
+    entry_point = (calc_entry_point(buy, 1.0).astype(int)
+                   + calc_entry_point(sell, -1.0).astype(int))
+    pnl = change[:, None] * (buy+sell) - entry_point * cost[:, None]
+    if swap_long != 0.0 or swap_short != 0.0:
+        rollover = (calc_rollover(op.index)*pip/op).reindex(index).values
+        pnl += rollover[:, None] * (buy*swap_long-sell*swap_short)
+    pnl[np.isnan(pnl)] = 0.0
+    pnl = pd.DataFrame(pnl, index=index, columns=buy_position.columns)
+    return pnl
+
 # ポジションを計算する。ドテンに対応しているか後日確認。
 def calc_position(buy_entry, buy_exit, sell_entry, sell_exit):
     # 買いポジションを求める。
@@ -372,6 +857,110 @@ def calc_position(buy_entry, buy_exit, sell_entry, sell_exit):
     sell_position = -sell.fillna(method='ffill')
     return buy_position, sell_position
 
+# ポジションを列ごとにまとめて計算する。
+# エントリーとエグジットが同時に出た場合はcalc_positionと同じく
+# エグジットを優先する。
+def calc_position_batch(buy_entry, buy_exit, sell_entry, sell_exit):
+    def ffill(entry, exit):
+        position = np.where(exit, 0.0, np.where(entry, 1.0, np.nan))
+        position[0] = 0.0
+        n = len(position)
+        index = np.where(np.isnan(position), 0, np.arange(n)[:, None])
+        index = np.maximum.accumulate(index, axis=0)
+        position = np.take_along_axis(position, index, axis=0)
+        return position
+    index = buy_entry.index
+    columns = buy_entry.columns
+    buy_position = ffill(buy_entry.values.astype(bool),
+                         buy_exit.values.astype(bool))
+    sell_position = -ffill(sell_entry.values.astype(bool),
+                           sell_exit.values.astype(bool))
+    buy_position = pd.DataFrame(buy_position, index=index, columns=columns)
+    sell_position = pd.DataFrame(sell_position, index=index, columns=columns)
+    return buy_position, sell_position
+
+# 損切り、利食いを含めてポジションを計算する。
+# MQL5のCheckForOpenと同じく売り買い合わせて1つのポジションだけを持ち、
+# ポジションがないときだけエントリーする。エグジットと反対側の
+# エントリーが同じ足で出たらドテンする。
+# slpips、tppipsはエントリーした足の始値からのpipsで、高値、安値が
+# 届いた足でその価格で決済し（窓を開けたときは始値）、決済価格を
+# exit_priceに入れる。同じ足で両方に届いた場合は損切りを優先する。
+def calc_position_with_stop(buy_entry, buy_exit, sell_entry, sell_exit,
+                            symbol, timeframe, slpips=None, tppips=None):
+    index = buy_entry.index
+    n = len(index)
+    buy_exit = buy_exit.values.astype(bool)
+    sell_exit = sell_exit.values.astype(bool)
+    # エグジットと同時に出た同じ側のエントリーは無視し、売り買いの
+    # エントリーが同時に出たらどちらもしない。
+    side = ((buy_entry.values.astype(bool) & ~buy_exit).astype(int)
+            - (sell_entry.values.astype(bool) & ~sell_exit).astype(int))
+    side[0] = 0
+    # 各足以降で最初にエントリー、エグジットが出る足を求めておく。
+    def next_true(condition):
+        no = np.where(condition, np.arange(n), n)
+        no = np.minimum.accumulate(no[::-1])[::-1]
+        return np.append(no, n)
+    next_entry = next_true(side!=0)
+    next_buy_exit = next_true(buy_exit)
+    next_sell_exit = next_true(sell_exit)
+    if slpips is None or slpips <= 0:
+        slpips = None
+    if tppips is None or tppips <= 0:
+        tppips = None
+    if slpips is not None or tppips is not None:
+        op = i_open(symbol, timeframe, 0)
+        pip = get_pip(op, symbol)
+        op = op.reindex(index).values
+        high = i_high(symbol, timeframe, 0).reindex(index).values
+        low = i_low(symbol, timeframe, 0).reindex(index).values
+    change = np.zeros(n+1)
+    exit_price = np.full(n, np.nan)
+    # トレードごとに、エグジットまでの足で損切り、利食いをまとめて調べる。
+    start = next_entry[0]
+    while start < n:
+        direction = side[start]
+        if direction == 1:
+            end = next_buy_exit[start]
+        else:
+            end = next_sell_exit[start]
+        if slpips is not None or tppips is not None:
+            # 売りは価格の符号を反転させて買いと同じように調べる。
+            entry_price = op[start] * direction
+            o = op[start:end] * direction
+            if direction == 1:
+                h, l = high[start:end], low[start:end]
+            else:
+                h, l = -low[start:end], -high[start:end]
+            sl_hit = np.zeros(end-start, dtype=bool)
+            tp_hit = np.zeros(end-start, dtype=bool)
+            if slpips is not None:
+                sl = entry_price - slpips*pip
+                sl_hit = l <= sl
+            if tppips is not None:
+                tp = entry_price + tppips*pip
+                tp_hit = h >= tp
+            hit = sl_hit | tp_hit
+            if hit.any():
+                k = np.argmax(hit)
+                if tp_hit[k] == True and o[k] >= tp:
+                    price = o[k]
+                elif sl_hit[k] == True:
+                    price = min(o[k], sl)
+                else:
+                    price = tp
+                exit_price[start+k] = price * direction
+                end = start + k + 1
+        change[start] += direction
+        change[end] -= direction
+        start = next_entry[end]
+    position = np.cumsum(change[:-1])
+    buy_position = pd.Series(np.maximum(position, 0.0), index=index)
+    sell_position = pd.Series(np.minimum(position, 0.0), index=index)
+    exit_price = pd.Series(exit_price, index=index)
+    return buy_position, sell_position, exit_price
+
 # 資産曲線の形状をR^2で計算する。
 def calc_r2(pnl, start, end):
     clf = linear_model.LinearRegression()
@@ -384,6 +973,231 @@ def calc_r2(pnl, start, end):
     r2 = clf.score(x, y)
     return r2
 
+# 資産曲線のR^2を列ごとにまとめて計算する。
+# 直線回帰のR^2は相関係数の2乗に等しいので閉じた式で求める。
+def calc_r2_batch(pnl, start, end):
+    y = np.cumsum(pnl[start:end].values, axis=0)
+    x = np.arange(len(y), dtype=float)
+    x -= x.mean()
+    y = y - y.mean(axis=0)
+    sxy = (x[:, None]*y).sum(axis=0)
+    sxx = (x*x).sum()
+    syy = (y*y).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(syy > 0.0, sxy * sxy / (sxx*syy), 1.0)
+    return r2
+
+# RCI（時間の順位と価格の順位のスピアマンの順位相関）を計算する。
+# ウィンドウをまとめて順位付けし、データをchunk_size要素ずつ1回だけ走査して
+# すべての期間を計算する。戻り値の列はperiodsの順。
+def calc_rci(values, periods, chunk_size=2**22):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    ret = np.full((n, len(periods)), np.nan)
+    count = np.concatenate([[0], np.cumsum(np.isnan(x))])
+    max_period = max(periods)
+    rows = max(1, chunk_size//max_period)
+    for start in range(0, n, rows):
+        end = min(n, start+rows)
+        for k in range(len(periods)):
+            period = periods[k]
+            first = max(start, period-1)
+            if first >= end:
+                continue
+            windows = sliding_window_view(x[first-period+1:end], period)
+            # 同順位は平均順位とし、scipy.stats.spearmanrと合わせる。
+            rank = rankdata(windows, axis=1) - (period+1)/2.0
+            no = np.arange(1, period+1) - (period+1)/2.0
+            sxy = rank @ no
+            syy = (rank*rank).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rci = sxy / np.sqrt((no*no).sum()*syy)
+            # NaNを含むウィンドウや値が一定のウィンドウはNaNとする。
+            nan = (count[first+1:end+1]
+                   - count[first-period+1:end-period+1]) > 0
+            rci[nan | (syy==0.0)] = np.nan
+            ret[first:end, k] = rci
+    return ret
+
+# 直近period本の最大値を計算する（NaNを含む窓はNaN）。
+# period本ごとのブロックの先頭からと末尾からの累積最大を求め、窓の最大値は
+# 窓の始まりの末尾からの累積最大と窓の終わりの先頭からの累積最大の大きい方とする。
+def calc_rolling_max(values, period):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    ret = np.full(n, np.nan)
+    if period < 1 or n < period:
+        return ret
+    m = -(-n//period) * period
+    a = np.full(m, -np.inf)
+    a[:n] = np.where(np.isnan(x), -np.inf, x)
+    a = a.reshape(-1, period)
+    prefix_max = np.maximum.accumulate(a, axis=1).ravel()
+    suffix_max = np.maximum.accumulate(a[:, ::-1], axis=1)[:, ::-1].ravel()
+    ret[period-1:] = np.maximum(suffix_max[:n-period+1], prefix_max[period-1:n])
+    count = np.concatenate([[0], np.cumsum(np.isnan(x))])
+    ret[period-1:][(count[period:]-count[:-period])>0] = np.nan
+    return ret
+
+# 複数の期間の移動平均をまとめて計算する（列はperiodsの順）。
+# momentsに辞書を渡せば、calc_rolling_momentsの累積和をcalc_rolling_varなどと
+# 使い回す（同じ値の配列に対してだけ使うこと）。
+def calc_rolling_mean(values, periods, moments=None):
+    if moments is None:
+        moments = {}
+    ret = np.full((len(values), len(periods)), np.nan, order='F')
+    for k in range(len(periods)):
+        calc_rolling_window(values, periods[k], moments, mean=ret[:, k],
+                            variance=0)
+    return ret
+
+# 移動平均、移動分散の計算に使う、size本ごとに区切った累積和を返す。
+# 区切りごとにその平均を引いてから累積し、区切りの先頭で0に戻すので、
+# 系列全体の累積和のような桁落ちは起きない。
+# 戻り値は1乗と2乗の累積和、区切りごとの平均、足ごとに引いた平均。
+def calc_rolling_moments(values, size):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    m = -(-n//size) * size
+    nan = np.isnan(x)
+    y = np.zeros(m)
+    y[:n] = x
+    y[:n][nan] = 0.0
+    count = np.zeros(m)
+    count[:n] = ~nan
+    center = (y.reshape(-1, size).sum(axis=1)
+              / np.maximum(count.reshape(-1, size).sum(axis=1), 1.0))
+    base = np.repeat(center, size)
+    y -= base
+    y[:n][nan] = 0.0
+    s1 = np.cumsum(y.reshape(-1, size), axis=1).ravel()
+    y *= y
+    s2 = np.cumsum(y.reshape(-1, size), axis=1).ravel()
+    return s1, s2, center, base
+
+# 複数の期間の移動標準偏差（不偏）をcalc_rolling_varからまとめて計算する。
+def calc_rolling_std(values, periods, moments=None):
+    ret = np.sqrt(calc_rolling_var(values, periods, moments))
+    return ret
+
+# 複数の期間の移動分散（不偏）をまとめて計算する（列はperiodsの順）。
+# momentsの使い方はcalc_rolling_meanと同じ。
+def calc_rolling_var(values, periods, moments=None):
+    if moments is None:
+        moments = {}
+    ret = np.full((len(values), len(periods)), np.nan, order='F')
+    mean = np.empty(len(values))
+    for k in range(len(periods)):
+        calc_rolling_window(values, periods[k], moments, mean=mean,
+                            var=ret[:, k])
+    return ret
+
+# period本の移動平均と移動分散（不偏）を計算する（NaNを含む窓はNaN）。
+# calc_rolling_momentsの累積和の差から求める。区切りは窓の4倍以上
+# （256本までの窓は1024本で共通）とし、区切りをまたぐ窓は前の区切りの部分和を
+# 今の区切りの平均を基準に直して足す。累積和はmomentsに保存して使い回す。
+# mean、varにNaNで埋めた配列を渡せばそこに書き込む。variance=0なら分散は
+# 計算せずNoneを返す。
+def calc_rolling_window(values, period, moments, mean=None, var=None,
+                        variance=1):
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    if mean is None:
+        mean = np.full(n, np.nan)
+    if variance == 0:
+        var = None
+    elif var is None:
+        var = np.full(n, np.nan)
+    if period < 1 or period > n:
+        return mean, var
+    variance = variance == 1 and period >= 2
+    size = 1024
+    while size < 4*period:
+        size *= 2
+    if size not in moments:
+        moments[size] = calc_rolling_moments(x, size)
+    s1, s2, center, base = moments[size]
+    sum1 = np.empty(n-period+1)
+    sum1[0] = s1[period-1]
+    np.subtract(s1[period:n], s1[:n-period], out=sum1[1:])
+    if variance:
+        sum2 = np.empty(n-period+1)
+        sum2[0] = s2[period-1]
+        np.subtract(s2[period:n], s2[:n-period], out=sum2[1:])
+    # 区切りをまたぐ窓（終わりが区切りの先頭からperiod本以内）を直す。
+    end = (np.arange(size, n, size)[:, None]+np.arange(period)).ravel()
+    end = end[end<n]
+    before = end - period
+    block = end // size
+    last = block*size - 1
+    prev_s1 = s1[last] - s1[before]
+    rest = last - before
+    d = center[block-1] - center[block]
+    sum1[end-period+1] = prev_s1 + rest*d + s1[end]
+    if variance:
+        sum2[end-period+1] = (s2[last] - s2[before] + 2.0*d*prev_s1
+                              + rest*d*d + s2[end])
+    out = mean[period-1:]
+    np.divide(sum1, period, out=out)
+    out += base[period-1:n]
+    if variance:
+        sum1 *= sum1
+        sum1 /= period
+        sum2 -= sum1
+        sum2 /= period - 1
+        np.maximum(sum2, 0.0, out=var[period-1:])
+    # rolling()と同じく、同じ値が続く窓は平均をその値、分散を0とする。
+    if 'change' not in moments:
+        moments['change'] = np.concatenate([[0], np.cumsum(x[1:]!=x[:-1])])
+        moments['nan'] = np.concatenate([[0], np.cumsum(np.isnan(x))])
+    change = moments['change']
+    flat = np.flatnonzero(change[period-1:] == change[:n-period+1])
+    out[flat] = x[period-1:][flat]
+    if variance:
+        var[period-1:][flat] = 0.0
+    nan_count = moments['nan']
+    if nan_count[-1] > 0:
+        window_nan = (nan_count[period:]-nan_count[:-period]) > 0
+        out[window_nan] = np.nan
+        if var is not None:
+            var[period-1:][window_nan] = np.nan
+    return mean, var
+
+# 足ごとに次の足までに日付をまたぐ日数を求める（スワップポイントの計算用）。
+# 金曜日から月曜日に持ち越せば3日となる。
+def calc_rollover(index):
+    day = index.asi8 // (60*60*24*10**9)
+    ret = pd.Series(np.append(np.diff(day), 0), index=index)
+    return ret
+
+# 条件が連続して成り立っている本数を計算する（成り立たない足は0）。
+# 2次元配列なら列ごとの計算を1回の配列演算でまとめて行う。
+def calc_run_length(condition):
+    condition = np.asarray(condition, dtype=bool)
+    no = np.arange(len(condition))
+    if condition.ndim == 2:
+        no = no[:, None]
+    last_false = np.maximum.accumulate(np.where(condition, -1, no), axis=0)
+    ret = np.where(condition, no-last_false, 0)
+    return ret
+
+# セッションごとの始値、その時点までの高値、安値を1回の走査で計算する。
+# sessionはセッションの長さ（分）で、1440なら日足、240なら4時間足、60なら1時間足。
+# offsetは時刻に足す分数で、例えばoffset=120ならデータの時刻で22:00に
+# セッションが切り替わる（サーバー時間がデータの時間より2時間進んでいる場合）。
+def calc_session(data, session, offset, how):
+    minute = data.index.asi8 // (60*10**9) + offset
+    key = minute // session
+    grouped = data.groupby(key)
+    if how == 'open':
+        ret = grouped.transform('first')
+    elif how == 'high':
+        ret = grouped.cummax()
+    elif how == 'low':
+        ret = grouped.cummin()
+    ret.index = data.index
+    return ret
+
 # シャープレシオを計算する。
 def calc_sharpe(pnl, timeframe, start, end):
     mean = pnl[start:end].mean()
@@ -394,6 +1208,16 @@ def calc_sharpe(pnl, timeframe, start, end):
         sharpe = 0.0
     return sharpe
 
+# シャープレシオを列ごとにまとめて計算する。
+def calc_sharpe_batch(pnl, timeframe, start, end):
+    values = pnl[start:end].values
+    mean = values.mean(axis=0)
+    std = values.std(axis=0, ddof=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > eps, mean / std * np.sqrt(260*1440/timeframe),
+                          0.0)
+    return sharpe
+
 # 歪度を計算する。
 def calc_skew(pnl, start, end):
     pnl[pnl==0.0] = np.nan
@@ -401,16 +1225,101 @@ def calc_skew(pnl, start, end):
     skew = pnl.skew()
     return skew
 
+# 時間帯ごとのスプレッド（pips）から足ごとのスプレッドを作る。
+# profileは0〜23時のスプレッドのリストか、時をキーとする辞書。
+def calc_spread_profile(symbol, timeframe, profile):
+    op = i_open(symbol, timeframe, 0)
+    profile = pd.Series(profile, dtype=float)
+    ret = time_hour(op.index).map(profile)
+    return ret
+
 # トレード数を計算する。
-def calc_trade(buy_position, sell_position, start, end):
+def calc_trade(buy_position, sell_position, start, end, exit_price=None):
     buy_entry_point = (buy_position==1.0) & (buy_position.shift(1)==0.0)
-    buy_entry_point = buy_entry_point.astype(int)
     sell_entry_point = (sell_position==-1.0) & (sell_position.shift(1)==0.0)
+    if exit_price is not None:
+        exited = exit_price.shift(1).notna()
+        buy_entry_point = buy_entry_point | ((buy_position==1.0) & exited)
+        sell_entry_point = sell_entry_point | ((sell_position==-1.0) & exited)
+    buy_entry_point = buy_entry_point.astype(int)
     sell_entry_point = sell_entry_point.astype(int)
     entry_point = buy_entry_point + sell_entry_point
     trade = entry_point[start:end].sum()
     return trade
 
+# トレード数を列ごとにまとめて計算する。
+def calc_trade_batch(buy_position, sell_position, start, end):
+    buy = buy_position[start:end].values
+    sell = sell_position[start:end].values
+    entry_point = (calc_entry_point(buy, 1.0).astype(int)
+                   + calc_entry_point(sell, -1.0).astype(int))
+    trade = entry_point.sum(axis=0)
+    return trade
+
+# datasetにアタッチしてからfuncを呼ぶ（grid_searchの各プロセスで使う）。
+def call_with_dataset(func, dataset, *args):
+    attach_dataset(dataset)
+    return func(*args)
+
+# キャッシュのエントリーが使えるか確認する。
+# 元データのフィンガープリントが変わっていたらエントリーを削除する。
+def check_cache_entry(key):
+    entry = get_manifest().get(key)
+    if entry is None:
+        return False
+    for path, fingerprint in entry['sources'].items():
+        if get_fingerprint(path) != fingerprint:
+            remove_cache_entry(key)
+            cache_manifest_info['invalidated'] += 1
+            return False
+    entry['atime'] = time.time()
+    return True
+
+# メモリー上のキャッシュを空にする。
+def clear_memory_cache():
+    memory_cache.clear()
+    memory_cache_info['bytes'] = 0
+    memory_cache_info['hits'] = 0
+    memory_cache_info['misses'] = 0
+
+# 指標の計算グラフを作成する。
+# add_indicatorで使う指標を追加し、evaluate_graphでまとめて計算すれば、
+# 変化率や累積和、移動平均など指標の間で共通する計算は1回で済む。
+def create_graph(symbol, timeframe):
+    graph = {}
+    graph['symbol'] = symbol
+    graph['timeframe'] = timeframe
+    graph['nodes'] = {}
+    graph['outputs'] = {}
+    return graph
+
+# ライブで1本ずつ足を受け取って指標を更新するストリームを作成する。
+# indicatorは'atr'、'hl_band'、'kairi'、'ma'、'std'、'trend_duration'、
+# 'z_score'のいずれか。足はupdate_streamで渡す。
+def create_stream(indicator, period, shift=0, mode='close'):
+    stream = {}
+    stream['indicator'] = indicator
+    stream['period'] = period
+    stream['mode'] = mode
+    # shift本前の足を使うため、直近shift+1本の足を保持する。
+    stream['bars'] = collections.deque(maxlen=shift+1)
+    stream['window'] = collections.deque()
+    stream['no'] = 0
+    stream['high'] = np.nan
+    stream['low'] = np.nan
+    stream['close'] = np.nan
+    stream['prev_close'] = np.nan
+    stream['mean'] = {'nobs': 0, 'sum': 0.0, 'neg': 0, 'add': 0.0,
+                      'remove': 0.0, 'same': 0, 'prev': np.nan}
+    stream['var'] = {'nobs': 0.0, 'mean': 0.0, 'ssqdm': 0.0, 'add': 0.0,
+                     'remove': 0.0, 'same': 0, 'prev': np.nan}
+    stream['max'] = collections.deque()
+    stream['min'] = collections.deque()
+    stream['above'] = None
+    stream['below'] = None
+    stream['last'] = np.nan
+    return stream
+
 # フォルダーを空にする。
 def empty_folder(folder):
     pathname = os.path.dirname(__file__)
@@ -421,6 +1330,62 @@ def empty_folder(folder):
     for filename in glob.glob(pathname + '/' + folder + '/*'):
         os.remove(filename)
 
+# 計算グラフの指標をまとめて計算し、名前ごとの辞書で返す。
+# ノードは依存するノードの後に追加されているので、追加した順に1回ずつ計算する。
+# 移動平均、移動分散はi_*_multiと同じくcalc_rolling_windowで計算する。
+# 移動平均はi_*関数と丸め誤差程度の差しか出ないが、移動標準偏差を使う指標は
+# rolling()の誤差（短い期間で相対1e-4程度）の分だけi_*関数と差が出る。
+def evaluate_graph(graph):
+    values = {}
+    for key in graph['nodes']:
+        values[key] = calc_graph_node(graph, key, values)
+    ret = {}
+    for name, (indicator, args, keys) in graph['outputs'].items():
+        temp = [values[key] for key in keys]
+        if indicator == 'hl_band':
+            close, high, low = temp
+            data = pd.DataFrame()
+            data['high'] = high
+            data['low'] = low
+            data['middle'] = (high + low) / 2
+        elif indicator == 'level':
+            # i_levelと同じく、埋めた後の高値、安値のバンドから計算する。
+            close, high, low = temp
+            high = fill_data(high)
+            low = fill_data(low)
+            data = pd.DataFrame()
+            data['high'] = (high-close) / close * 100.0
+            data['low'] = (close-low) / low * 100.0
+        elif indicator == 'random_walk':
+            close, lag, var = temp
+            data = ((close-lag)/lag) / (np.sqrt(var)*np.sqrt(args[0]))
+        elif indicator == 'roc':
+            close, lag = temp
+            data = (close / lag - 1.0) * 100.0
+        elif indicator == 'standardized_kairi' or indicator == 'z_score':
+            data = (temp[0]-temp[1]) / np.sqrt(temp[2])
+        elif indicator == 'std' or indicator == 'std_dev':
+            data = np.sqrt(temp[0])
+        else:
+            data = temp[0]
+        ret[name] = fill_data(data)
+    return ret
+
+# キャッシュの容量が上限を超えたら最も長く使われていないエントリーから削除する。
+def evict_cache(keep=None):
+    manifest = get_manifest()
+    total = sum([entry['bytes'] for entry in manifest.values()])
+    if total <= cache_manifest_info['max_bytes']:
+        return
+    for key in sorted(manifest, key=lambda key: manifest[key]['atime']):
+        if key == keep:
+            continue
+        total -= manifest[key]['bytes']
+        remove_cache_entry(key)
+        cache_manifest_info['evicted'] += 1
+        if total <= cache_manifest_info['max_bytes']:
+            break
+
 # データを補完する。
 # NAを埋める関数を利用してデータで補完する。
 def fill_data(data):
@@ -522,6 +1487,21 @@ def get_base_and_quote(symbol):
         print('error: get_base_and_quote')
     return base, quote
 
+# キャッシュのpklファイルのパスを返す。
+# スカラーの引数はそのまま文字列にし、インデックスなどはハッシュ値にする。
+def get_cache_file_path(func_name, signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    arg_values = ''
+    for value in bound.arguments.values():
+        if value is None or (isinstance(value, (str, int, float, np.number))
+                             and len(str(value)) < 30):
+            arg_values += '_' + str(value)
+        else:
+            arg_values += '_' + joblib.hash(value)
+    pkl_file_path = get_temp_dir() + func_name + arg_values + '.pkl'
+    return pkl_file_path
+
 def get_current_filename():
     pathname = os.path.dirname(__file__)
     current_filename = inspect.currentframe().f_back.f_code.co_filename
@@ -529,6 +1509,27 @@ def get_current_filename():
     current_filename, ext = os.path.splitext(current_filename)
     return current_filename
 
+# ファイルのフィンガープリント（更新時刻とサイズ）を返す。
+def get_fingerprint(path):
+    if os.path.exists(path) == False:
+        return None
+    stat = os.stat(path)
+    fingerprint = [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+# キャッシュの管理情報を返す。最初の1回だけmanifest.jsonから読み込む。
+def get_manifest():
+    global cache_manifest
+    if cache_manifest is None:
+        path = get_temp_dir() + 'manifest.json'
+        if os.path.exists(path) == True:
+            with open(path) as f:
+                cache_manifest = json.load(f)
+        else:
+            cache_manifest = {}
+        atexit.register(save_manifest)
+    return cache_manifest
+
 def get_model_dir():
     dirname = os.path.dirname(__file__)
     filename = inspect.currentframe().f_back.f_code.co_filename
@@ -537,656 +1538,979 @@ def get_model_dir():
     model_dir = dirname + '/' + filename
     return model_dir
 
-def get_pkl_file_path():
-    pathname = os.path.dirname(__file__)
-    # tempフォルダーがなければ作成する。
-    if os.path.exists(pathname + '/temp') == False:
-        os.mkdir(pathname + '/temp')
-    dir_name = os.path.dirname(__file__) + '/temp/'
-    framerecords = inspect.stack()
-    framerecord = framerecords[1]
-    frame = framerecord[0]
-    func_name = frame.f_code.co_name
-    ls = list(inspect.getargvalues(frame)[3].values())
-    size = len(ls)
-    arg_values = ''
-    for i in range(size):
-        if len(str(ls[size-1-i])) < 30:
-            arg_values += '_' + str(ls[size-1-i])
-        else:
-            arg_values += '_index'
-    arg_values += '.pkl'
-    pkl_file_path = dir_name + func_name + arg_values
-    return pkl_file_path
-
+# データのメモリー使用量（バイト）を返す。
+def get_nbytes(data):
+    # コンパクトモードでは時間インデックスを共有するので数えない。
+    if isinstance(data, pd.DataFrame):
+        nbytes = data.memory_usage(index=compact_mode==0).sum()
+    elif isinstance(data, pd.Series):
+        nbytes = data.memory_usage(index=compact_mode==0)
+    elif isinstance(data, np.ndarray):
+        nbytes = data.nbytes
+    else:
+        nbytes = sys.getsizeof(data)
+    return int(nbytes)
+
+# 価格から1pipの大きさを推定する。
+def get_pip(op, symbol=None):
+    if symbol in pip_size:
+        pip = pip_size[symbol]
+    elif op.iloc[len(op)-1] >= 1000.0:  # 例えばUS500で6.0pisなら6.0ドル。
+        pip = 1.0
+    elif op.iloc[len(op)-1] >= 5.0:  # 例えばUSDJPYで0.4pisなら0.004円。
+        pip = 0.01
+    else:  # 例えばEURUSDで0.5pisなら0.00005ドル。
+        pip = 0.0001
+    return pip
+
+# 価格データを列ごとに保存するフォルダーのパスを返す。
+def get_price_store_dir(symbol, timeframe):
+    dirname = os.path.expanduser(
+            '~/py/historical_data/' + symbol + str(timeframe))
+    return dirname
+
+# tempフォルダーのパスを返す。
+# フォルダーの確認と作成は最初の1回だけ行う。
+def get_temp_dir():
+    global temp_dir
+    if temp_dir is None:
+        dirname = os.path.dirname(os.path.abspath(__file__)) + '/temp/'
+        if os.path.exists(dirname) == False:
+            os.makedirs(dirname, exist_ok=True)
+        temp_dir = dirname
+    return temp_dir
+
+# グリッドサーチで最適なパラメータを求める。
+# scipy.optimize.bruteと同じグリッドをプロセスプールで並列に評価する。
+# 戻り値は最適なパラメータとスコアのグリッド（bruteのJoutと同じ形）。
+def grid_search(func, rranges, args=(), n_jobs=1, Ns=20, dataset=None):
+    n = len(rranges)
+    lrange = list(rranges)
+    for k in range(n):
+        if not isinstance(lrange[k], slice):
+            if len(lrange[k]) < 3:
+                lrange[k] = tuple(lrange[k]) + (complex(Ns),)
+            lrange[k] = slice(*lrange[k])
+    if n == 1:
+        lrange = lrange[0]
+    grid = np.mgrid[lrange]
+    shape = grid.shape
+    if n > 1:
+        points = np.reshape(grid, (shape[0], np.prod(shape[1:]))).T
+        shape = shape[1:]
+    else:
+        points = grid
+    # datasetがあれば各プロセスで共有メモリーのデータを使う。
+    if dataset is not None:
+        scores = joblib.Parallel(n_jobs=n_jobs)(
+                joblib.delayed(call_with_dataset)(
+                        func, dataset, np.asarray(x).flatten(), *args)
+                for x in points)
+    else:
+        scores = joblib.Parallel(n_jobs=n_jobs)(
+                joblib.delayed(func)(np.asarray(x).flatten(), *args)
+                for x in points)
+    scores = np.array(scores, dtype=float).reshape(shape)
+    # bruteと同じく最初に見つかった最小値を採用する。
+    index = np.argmin(scores.ravel())
+    inputs = np.asarray(points[index], dtype=float).flatten()
+    return inputs, scores
+
+@cache_pkl
 def i_atr(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        high = i_high(symbol, timeframe, shift)
-        low = i_low(symbol, timeframe, shift)
-        close = i_close(symbol, timeframe, shift)
-        temp = high - low
-        temp = pd.concat([temp, high - close.shift(1)], axis=1)
-        temp = pd.concat([temp, close.shift(1) - low], axis=1)
-        tr = temp.max(axis=1)
-        ret = tr.rolling(window=period).mean()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    high = i_high(symbol, timeframe, shift)
+    low = i_low(symbol, timeframe, shift)
+    close = i_close(symbol, timeframe, shift)
+    temp = high - low
+    temp = pd.concat([temp, high - close.shift(1)], axis=1)
+    temp = pd.concat([temp, close.shift(1) - low], axis=1)
+    tr = temp.max(axis=1)
+    ret = tr.rolling(window=period).mean()
+    ret = fill_data(ret)
     return ret
 
+# 複数の期間のATRをまとめて返す（列は期間）。
+@cache_pkl
+def i_atr_multi(symbol, timeframe, periods, shift):
+    high = i_high(symbol, timeframe, shift)
+    low = i_low(symbol, timeframe, shift)
+    close = i_close(symbol, timeframe, shift)
+    temp = high - low
+    temp = pd.concat([temp, high - close.shift(1)], axis=1)
+    temp = pd.concat([temp, close.shift(1) - low], axis=1)
+    tr = temp.max(axis=1)
+    ret = pd.DataFrame(calc_rolling_mean(tr.values, periods),
+                       index=tr.index, columns=list(periods))
+    ret = fill_data(ret)
+    return ret
+
+@cache_pkl
 def i_close(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        filename = ('~/py/historical_data/' + symbol + str(timeframe) +
-            '.csv')
-        temp = pd.read_csv(filename, index_col=0, header=0)
-        index = pd.to_datetime(temp.index)
-        temp.index = index
-        ret = temp.iloc[:, 3]
-        ret = ret.shift(shift)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = load_price(symbol, timeframe, 'close')
+    ret = ret.shift(shift)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_daily_high(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        high = i_high(symbol, timeframe, shift)
-        index = high.index
-        temp = high.copy()
-        temp[(time_hour(index)!=0) | (time_minute(index)!=0)] = np.nan
-        temp = temp.fillna(method='ffill')
-        ret = high.copy()
-        ret[ret<temp] = np.nan
-        ret = ret.fillna(method='ffill')
-        while(True):
-            ret[((time_hour(index)!=0) | (time_minute(index)!=0))
-            & (ret < ret.shift(1))] = np.nan
-            if ret.isnull().sum()==0:
-                break
-            ret = ret.fillna(method='ffill')
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    high = i_high(symbol, timeframe, shift)
+    ret = calc_session(high, 1440, 0, 'high')
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_daily_low(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        low = i_low(symbol, timeframe, shift)
-        index = low.index
-        temp = low.copy()
-        temp[(time_hour(index)!=0) | (time_minute(index)!=0)] = np.nan
-        temp = temp.fillna(method='ffill')
-        ret = low.copy()
-        ret[ret>temp] = np.nan
-        ret = ret.fillna(method='ffill')
-        while(True):
-            ret[((time_hour(index)!=0) | (time_minute(index)!=0))
-            & (ret > ret.shift(1))] = np.nan
-            if ret.isnull().sum()==0:
-                break
-            ret = ret.fillna(method='ffill')
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    low = i_low(symbol, timeframe, shift)
+    ret = calc_session(low, 1440, 0, 'low')
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_daily_open(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        op = i_open(symbol, timeframe, shift)
-        index = op.index
-        ret = op.copy()
-        ret[(time_hour(index)!=0) | (time_minute(index)!=0)] = np.nan
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    op = i_open(symbol, timeframe, shift)
+    index = op.index
+    ret = op.copy()
+    ret[(time_hour(index)!=0) | (time_minute(index)!=0)] = np.nan
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_four_hourly_open(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        op = i_open(symbol, timeframe, shift)
-        index = op.index
-        ret = op.copy()
-        ret[time_hour(index)%4!=0] = np.nan
-        ret[time_minute(index)!=0] = np.nan
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    op = i_open(symbol, timeframe, shift)
+    index = op.index
+    ret = op.copy()
+    ret[time_hour(index)%4!=0] = np.nan
+    ret[time_minute(index)!=0] = np.nan
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_high(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        filename = ('~/py/historical_data/' + symbol + str(timeframe) +
-            '.csv')
-        temp = pd.read_csv(filename, index_col=0, header=0)
-        index = pd.to_datetime(temp.index)
-        temp.index = index
-        ret = temp.iloc[:, 1]
-        ret = ret.shift(shift)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = load_price(symbol, timeframe, 'high')
+    ret = ret.shift(shift)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_highest(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        def func(high):
-            period = len(high)
-            argmax = high.argmax()
-            ret = period - 1 - argmax
-            return ret
-        high = i_high(symbol, timeframe, shift)
-        ret = high.rolling(window=period).apply(func, raw=True)
-        ret = fill_data(ret)
-        ret = ret.astype(int)
-        save_pkl(ret, pkl_file_path)
+    high = i_high(symbol, timeframe, shift)
+    ret = pd.Series(calc_bars_since_max(high.values, period),
+                    index=high.index)
+    ret = fill_data(ret)
+    ret = ret.astype(int)
     return ret
 
+@cache_pkl
 def i_hl_band(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        high = i_high(symbol, timeframe, shift)
-        low = i_low(symbol, timeframe, shift)
-        ret = pd.DataFrame()
-        ret['high'] = high.rolling(window=period).max()
-        ret['low'] = low.rolling(window=period).min()
-        ret['middle'] = (ret['high'] + ret['low']) / 2
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    high = i_high(symbol, timeframe, shift)
+    low = i_low(symbol, timeframe, shift)
+    ret = pd.DataFrame()
+    ret['high'] = high.rolling(window=period).max()
+    ret['low'] = low.rolling(window=period).min()
+    ret['middle'] = (ret['high'] + ret['low']) / 2
+    ret = fill_data(ret)
     return ret
 
+# 複数の期間のHLバンドをまとめて返す。
+# 列は('high', 期間)、('low', 期間)、('middle', 期間)のMultiIndex。
+@cache_pkl
+def i_hl_band_multi(symbol, timeframe, periods, shift):
+    high = i_high(symbol, timeframe, shift)
+    low = i_low(symbol, timeframe, shift)
+    ret = {}
+    for period in periods:
+        ret[('high', period)] = calc_rolling_max(high.values, period)
+    for period in periods:
+        ret[('low', period)] = -calc_rolling_max(-low.values, period)
+    for period in periods:
+        ret[('middle', period)] = (
+                (ret[('high', period)] + ret[('low', period)]) / 2)
+    ret = pd.DataFrame(ret, index=high.index)
+    ret = fill_data(ret)
+    return ret
+
+@cache_pkl
 def i_hourly_open(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        op = i_open(symbol, timeframe, shift)
-        index = op.index
-        ret = op.copy()
-        ret[time_minute(index)!=0] = np.nan
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    op = i_open(symbol, timeframe, shift)
+    index = op.index
+    ret = op.copy()
+    ret[time_minute(index)!=0] = np.nan
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_kairi(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    kairi = restore_pkl(pkl_file_path)
-    if kairi is None:
-        close = i_close(symbol, timeframe, shift)
-        mean = close.rolling(window=period).mean()
-        kairi = (close-mean) / mean * 100.0
-        kairi = fill_data(kairi)
-        save_pkl(kairi, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    mean = close.rolling(window=period).mean()
+    kairi = (close-mean) / mean * 100.0
+    kairi = fill_data(kairi)
     return kairi
 
+# 複数の期間の移動平均乖離率をまとめて返す（列は期間）。
+@cache_pkl
+def i_kairi_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    mean = calc_rolling_mean(close.values, periods)
+    kairi = (close.values[:, None]-mean) / mean * 100.0
+    kairi = pd.DataFrame(kairi, index=close.index, columns=list(periods))
+    kairi = fill_data(kairi)
+    return kairi
+
+# 通貨強弱のうち、フラグが1の通貨を選んで返す。
+# i_ku_panelから選んだ通貨の列を取り出し、平均を引くだけにしてキャッシュしない
+# （通貨の組み合わせごとのpklファイルは作らない）。
 def i_ku_close(timeframe, shift, aud=0, cad=0, chf=0, eur=0, gbp=0, jpy=0,
                nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        audusd = 0.0
-        cadusd = 0.0
-        chfusd = 0.0
-        eurusd = 0.0
-        gbpusd = 0.0
-        jpyusd = 0.0
-        nzdusd = 0.0
-        if aud == 1:
-            audusd = np.log(i_close('AUDUSD', timeframe, shift))
-        if cad == 1:
-            cadusd = -np.log(i_close('USDCAD', timeframe, shift))
-        if chf == 1:
-            chfusd = -np.log(i_close('USDCHF', timeframe, shift))
-        if eur == 1:
-            eurusd = np.log(i_close('EURUSD', timeframe, shift))
-        if gbp == 1:
-            gbpusd = np.log(i_close('GBPUSD', timeframe, shift))
-        if jpy == 1:
-            jpyusd = -np.log(i_close('USDJPY', timeframe, shift))
-        if nzd == 1:
-            nzdusd = np.log(i_close('NZDUSD', timeframe, shift))
-        n = aud + cad + chf + eur + gbp + jpy + nzd + usd
-        a = (audusd * aud + cadusd * cad + chfusd * chf + eurusd * eur
-             + gbpusd * gbp + jpyusd * jpy + nzdusd * nzd) / n
-        ret = pd.DataFrame()
-        if aud == 1:
-            ret['AUD'] = audusd - a
-        if cad == 1:
-            ret['CAD'] = cadusd - a
-        if chf == 1:
-            ret['CHF'] = chfusd - a
-        if eur == 1:
-            ret['EUR'] = eurusd - a
-        if gbp == 1:
-            ret['GBP'] = gbpusd - a
-        if jpy == 1:
-            ret['JPY'] = jpyusd - a
-        if nzd == 1:
-            ret['NZD'] = nzdusd - a
-        if usd == 1:
-            ret['USD'] = -a
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    flags = {'AUD': aud, 'CAD': cad, 'CHF': chf, 'EUR': eur, 'GBP': gbp,
+             'JPY': jpy, 'NZD': nzd, 'USD': usd}
+    currencies = [currency for currency in flags if flags[currency] == 1]
+    # 選んだ通貨ペアのどれにも足がない時間を除き、その通貨ペアだけの
+    # 和集合の時間に戻す。
+    panel = i_ku_panel(timeframe, shift)
+    panel = panel[[currency for currency in currencies if currency != 'USD']]
+    panel = panel.dropna(how='all')
+    # 足がそろわない時間は平均をNaNとし、最後に前後の値で埋める。
+    a = 0.0
+    for currency in panel.columns:
+        a = a + panel[currency]
+    a = a / len(currencies)
+    ret = panel.sub(a, axis=0)
+    if usd == 1:
+        ret['USD'] = -a
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_ku_ma(timeframe, period, shift, aud=0, cad=0, chf=0, eur=0, gbp=0,
              jpy=0, nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
-                              eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
-        ret = ku_close.rolling(window=period).mean()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
+                          eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
+    ret = ku_close.rolling(window=period).mean()
+    ret = fill_data(ret)
+    return ret
+
+# 各通貨（USD以外）の対ドルの対数価格を列とするDataFrameを返す。
+# 全ての通貨ペアを1回だけ読み込んでキャッシュし、i_ku_closeで列を選んで使う。
+# 足の時間は和集合でそろえ、ない足はNaNのままとする。データがない通貨ペアの
+# 列は作らない。
+@cache_pkl
+def i_ku_panel(timeframe, shift):
+    legs = {'AUD': ('AUDUSD', 1.0), 'CAD': ('USDCAD', -1.0),
+            'CHF': ('USDCHF', -1.0), 'EUR': ('EURUSD', 1.0),
+            'GBP': ('GBPUSD', 1.0), 'JPY': ('USDJPY', -1.0),
+            'NZD': ('NZDUSD', 1.0)}
+    data = {}
+    for currency, (symbol, sign) in legs.items():
+        try:
+            close = i_close(symbol, timeframe, shift)
+        except FileNotFoundError:
+            continue
+        data[currency] = sign * np.log(close)
+    ret = pd.DataFrame(data)
     return ret
 
+@cache_pkl
 def i_ku_roc(timeframe, period, shift, aud=0, cad=0, chf=0, eur=0, gbp=0,
              jpy=0, nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
-                              eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
-        ret = (ku_close-ku_close.shift(period)) * 100.0
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
+                          eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
+    ret = (ku_close-ku_close.shift(period)) * 100.0
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_ku_trend_duration(timeframe, period, shift, aud=0, cad=0, chf=0, eur=0,
                         gbp=0, jpy=0, nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        ku_close = i_ku_close(timeframe, shift, aud, cad, chf, eur, gbp, jpy,
-                              nzd, usd)
-        ku_ma = ku_close.rolling(window=period).mean()
-        n_col = len(ku_close.columns)
-        above = pd.DataFrame(columns=ku_close.columns)
-        below = pd.DataFrame(columns=ku_close.columns)
-        for i in range(n_col):
-            above.iloc[:, i] = (ku_close > ku_ma).iloc[:, i]
-            above.iloc[:, i] = above.iloc[:, i] * (above.iloc[:, i].groupby(
-                    (above.iloc[:, i]!=above.iloc[:, i].shift()).cumsum()
-                    ).cumcount()+1)
-            below.iloc[:, i] = (ku_close < ku_ma).iloc[:, i]
-            below.iloc[:, i] = below.iloc[:, i] * (below.iloc[:, i].groupby(
-                    (below.iloc[:, i]!=below.iloc[:, i].shift()).cumsum()
-                    ).cumcount()+1)
-        ret = above - below
-        ret = fill_data(ret)
-        ret = ret.astype(int)
-        save_pkl(ret, pkl_file_path)
+    ku_close = i_ku_close(timeframe, shift, aud, cad, chf, eur, gbp, jpy,
+                          nzd, usd)
+    ku_ma = ku_close.rolling(window=period).mean()
+    above = calc_run_length((ku_close > ku_ma).values)
+    below = calc_run_length((ku_close < ku_ma).values)
+    ret = pd.DataFrame(above-below, index=ku_close.index,
+                       columns=ku_close.columns)
+    ret = fill_data(ret)
+    ret = ret.astype(int)
     return ret
 
+@cache_pkl
 def i_ku_z_score(
         timeframe, period, shift, aud=0, cad=0, chf=0, eur=0, gbp=0, jpy=0,
         nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
-                              eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
-        mean = ku_close.rolling(window=period).mean()
-        std = ku_close.rolling(window=period).std()
-        ret = (ku_close-mean) / std
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ku_close = i_ku_close(timeframe, shift, aud=aud, cad=cad, chf=chf,
+                          eur=eur, gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
+    mean = ku_close.rolling(window=period).mean()
+    std = ku_close.rolling(window=period).std()
+    ret = (ku_close-mean) / std
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_kurt(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        ret = change.rolling(window=period).kurt()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = change.rolling(window=period).kurt()
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_level(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        ret = pd.DataFrame()
-        close = i_close(symbol, timeframe, shift)
-        hl_band = i_hl_band(symbol, timeframe, period, shift)
-        ret['high'] = (hl_band['high']-close) / close * 100.0
-        ret['low'] = (close-hl_band['low']) / hl_band['low'] * 100.0
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = pd.DataFrame()
+    close = i_close(symbol, timeframe, shift)
+    hl_band = i_hl_band(symbol, timeframe, period, shift)
+    ret['high'] = (hl_band['high']-close) / close * 100.0
+    ret['low'] = (close-hl_band['low']) / hl_band['low'] * 100.0
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_low(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        filename = ('~/py/historical_data/' + symbol + str(timeframe) +
-            '.csv')
-        temp = pd.read_csv(filename, index_col=0, header=0)
-        index = pd.to_datetime(temp.index)
-        temp.index = index
-        ret = temp.iloc[:, 2]
-        ret = ret.shift(shift)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = load_price(symbol, timeframe, 'low')
+    ret = ret.shift(shift)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_lowest(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        def func(low):
-            period = len(low)
-            argmin = low.argmin()
-            ret = period - 1 - argmin
-            return ret
-        low = i_low(symbol, timeframe, shift)
-        ret = low.rolling(window=period).apply(func, raw=True)
-        ret = fill_data(ret)
-        ret = ret.astype(int)
-        save_pkl(ret, pkl_file_path)
+    low = i_low(symbol, timeframe, shift)
+    ret = pd.Series(calc_bars_since_max(-low.values, period),
+                    index=low.index)
+    ret = fill_data(ret)
+    ret = ret.astype(int)
     return ret
 
+@cache_pkl
 def i_ma(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        ret = close.rolling(window=period).mean()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    ret = close.rolling(window=period).mean()
+    ret = fill_data(ret)
+    return ret
+
+# 複数の期間の移動平均をまとめて返す（列は期間）。
+@cache_pkl
+def i_ma_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    ret = pd.DataFrame(calc_rolling_mean(close.values, periods),
+                       index=close.index, columns=list(periods))
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_mean(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        ret = change.rolling(window=period).mean()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = change.rolling(window=period).mean()
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_open(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        filename = ('~/py/historical_data/' + symbol + str(timeframe) +
-            '.csv')
-        temp = pd.read_csv(filename, index_col=0, header=0)
-        index = pd.to_datetime(temp.index)
-        temp.index = index
-        ret = temp.iloc[:, 0]
-        ret = ret.shift(shift)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = load_price(symbol, timeframe, 'open')
+    ret = ret.shift(shift)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_percentrank(timeframe, period, shift, aud=0, cad=0, chf=0, eur=0, gbp=0,
                   jpy=0, nzd=0, usd=0):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        temp = i_ku_z_score(
-                timeframe, period, shift, aud=aud, cad=cad, chf=chf, eur=eur,
-                gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
-        n = aud + cad + chf + eur + gbp + jpy + nzd + usd
-        ret = temp.rank(axis=1, method='first')
-        ret -= 1
-        ret /= (n - 1)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    temp = i_ku_z_score(
+            timeframe, period, shift, aud=aud, cad=cad, chf=chf, eur=eur,
+            gbp=gbp, jpy=jpy, nzd=nzd, usd=usd)
+    n = aud + cad + chf + eur + gbp + jpy + nzd + usd
+    ret = temp.rank(axis=1, method='first')
+    ret -= 1
+    ret /= (n - 1)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_random_walk(symbol, timeframe, fast_period, slow_period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        # mean = 0.0
-        std = change.rolling(window=slow_period).std()
-        ret = ((close-close.shift(fast_period))/close.shift(fast_period)) / (std*np.sqrt(fast_period))
-#        change = np.log(close) - np.log(close.shift(1))
-#        # mean = 0.0
-#        std = change.rolling(window=slow_period).std()
-#        ret = (np.log(close)-np.log(close.shift(fast_period))) / (std*np.sqrt(fast_period))
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    # mean = 0.0
+    std = change.rolling(window=slow_period).std()
+    ret = ((close-close.shift(fast_period))/close.shift(fast_period)) / (std*np.sqrt(fast_period))
+#    change = np.log(close) - np.log(close.shift(1))
+#    # mean = 0.0
+#    std = change.rolling(window=slow_period).std()
+#    ret = (np.log(close)-np.log(close.shift(fast_period))) / (std*np.sqrt(fast_period))
+    ret = fill_data(ret)
     return ret
 
 # RCIを返す。
-# 短い足だと時間かかりまくり。
+@cache_pkl
 def i_rci(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        def func(close):
-            n = len(close)
-            no = np.arange(n)
-            ret = spearmanr(no, close)[0]
-            return ret
-        close = i_close(symbol, timeframe, shift)
-        ret = close.rolling(window=period).apply(func, raw=True)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    ret = pd.Series(calc_rci(close.values, [period])[:, 0], index=close.index)
+    ret = fill_data(ret)
     return ret
 
+# 複数の期間のRCIをまとめて返す（列は期間）。
+@cache_pkl
+def i_rci_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    ret = pd.DataFrame(calc_rci(close.values, periods), index=close.index,
+                       columns=list(periods))
+    ret = fill_data(ret)
+    return ret
+
+@cache_pkl
 def i_roc(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        ret = (close / close.shift(period) - 1.0) * 100.0
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    ret = (close / close.shift(period) - 1.0) * 100.0
+    ret = fill_data(ret)
     return ret
 
+# 複数の期間の変化率をまとめて返す（列は期間）。
+@cache_pkl
+def i_roc_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    x = close.values
+    ret = np.full((len(x), len(periods)), np.nan)
+    for k in range(len(periods)):
+        period = periods[k]
+        if period < len(x):
+            ret[period:, k] = (x[period:] / x[:-period] - 1.0) * 100.0
+    ret = pd.DataFrame(ret, index=close.index, columns=list(periods))
+    ret = fill_data(ret)
+    return ret
+
+@cache_pkl
 def i_skew(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        ret = change.rolling(window=period).skew()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = change.rolling(window=period).skew()
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_standardized_kairi(symbol, timeframe, fast_period, slow_period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        ma = close.rolling(window=fast_period).mean()
-        kairi = (close-ma) / ma * 100.0
-        mean = kairi.rolling(window=slow_period).mean()
-        std = kairi.rolling(window=slow_period).std()
-        ret = (kairi-mean) / std
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    ma = close.rolling(window=fast_period).mean()
+    kairi = (close-ma) / ma * 100.0
+    mean = kairi.rolling(window=slow_period).mean()
+    std = kairi.rolling(window=slow_period).std()
+    ret = (kairi-mean) / std
+    ret = fill_data(ret)
+    return ret
+
+# セッション（sessionは分、offsetはcalc_sessionを参照）の高値を返す。
+@cache_pkl
+def i_session_high(symbol, timeframe, session, shift, offset=0):
+    high = i_high(symbol, timeframe, shift)
+    ret = calc_session(high, session, offset, 'high')
+    ret = fill_data(ret)
+    return ret
+
+# セッション（sessionは分、offsetはcalc_sessionを参照）の安値を返す。
+@cache_pkl
+def i_session_low(symbol, timeframe, session, shift, offset=0):
+    low = i_low(symbol, timeframe, shift)
+    ret = calc_session(low, session, offset, 'low')
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_std(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        ret = change.rolling(window=period).std()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = change.rolling(window=period).std()
+    ret = fill_data(ret)
+    return ret
+
+# 複数の期間の変化率の標準偏差をまとめて返す（列は期間）。
+@cache_pkl
+def i_std_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = pd.DataFrame(calc_rolling_std(change.values, periods),
+                       index=close.index, columns=list(periods))
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_std_dev(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        ret = close.rolling(window=period).std()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    ret = close.rolling(window=period).std()
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_trading_hours(ts, exchange):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
     #trading hours
     # tse: 02:00-08:00 (03:00-09:00)
     # les: 10:00-18:30
     # nyse: 16:30-23:00
     #summer time
     # usa: 03-10 (not exact)
-    if ret is None:
-        if exchange == 'tse':
-            ret = pd.Series(np.zeros(len(ts)), index=ts.index)
-            ret[(time_month(ts)<3) | (time_month(ts)>10)] = (
-                    (time_hour(ts)>=2) & (time_hour(ts)<8))
-            ret[(time_month(ts)>=3) & (time_month(ts)<=10)] = (
-                    (time_hour(ts)>=3) & (time_hour(ts)<9))
-        elif exchange == 'lse':
-            ret = (((time_hour(ts)>=10) & (time_hour(ts)<18)) |
-                    ((time_hour(ts)==18) & (time_minute(ts)<30)))
-        elif exchange == 'nyse':
-            ret = (((time_hour(ts)==16) & (time_minute(ts)>=30)) |
-                    ((time_hour(ts)>=17) & (time_hour(ts)<23)))
-        else:
-            ret = time_hour(ts) < 0
-        ret = fill_data(ret)
-        ret = ret.astype(int)
-        save_pkl(ret, pkl_file_path)
+    if exchange == 'tse':
+        ret = pd.Series(np.zeros(len(ts)), index=ts.index)
+        ret[(time_month(ts)<3) | (time_month(ts)>10)] = (
+                (time_hour(ts)>=2) & (time_hour(ts)<8))
+        ret[(time_month(ts)>=3) & (time_month(ts)<=10)] = (
+                (time_hour(ts)>=3) & (time_hour(ts)<9))
+    elif exchange == 'lse':
+        ret = (((time_hour(ts)>=10) & (time_hour(ts)<18)) |
+                ((time_hour(ts)==18) & (time_minute(ts)<30)))
+    elif exchange == 'nyse':
+        ret = (((time_hour(ts)==16) & (time_minute(ts)>=30)) |
+                ((time_hour(ts)>=17) & (time_hour(ts)<23)))
+    else:
+        ret = time_hour(ts) < 0
+    ret = fill_data(ret)
+    ret = ret.astype(int)
     return ret
 
+@cache_pkl
 def i_trend_duration(symbol, timeframe, period, mode, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        if mode == 'close':
-            close = i_close(symbol, timeframe, shift)
-            ma = i_ma(symbol, timeframe, period, shift)
-            above = close > ma
-            above = above * (above.groupby(
-                    (above!=above.shift()).cumsum()).cumcount()+1)
-            below = close < ma
-            below = below * (below.groupby(
-                    (below!=below.shift()).cumsum()).cumcount()+1)
-        elif mode == 'highlow':
-            high = i_high(symbol, timeframe, shift)
-            low = i_low(symbol, timeframe, shift)
-            ma = i_ma(symbol, timeframe, period, shift)
-            above = low > ma
-            above = above * (above.groupby(
-                    (above!=above.shift()).cumsum()).cumcount()+1)
-            below = high < ma
-            below = below * (below.groupby(
-                    (below!=below.shift()).cumsum()).cumcount()+1)
-        ret = (above-below) / period
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    if mode == 'close':
+        close = i_close(symbol, timeframe, shift)
+        ma = i_ma(symbol, timeframe, period, shift)
+        above = calc_run_length((close > ma).values)
+        below = calc_run_length((close < ma).values)
+    elif mode == 'highlow':
+        high = i_high(symbol, timeframe, shift)
+        low = i_low(symbol, timeframe, shift)
+        ma = i_ma(symbol, timeframe, period, shift)
+        above = calc_run_length((low > ma).values)
+        below = calc_run_length((high < ma).values)
+    ret = pd.Series((above-below) / period, index=ma.index)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_var(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / close.shift(1)
-        ret = change.rolling(window=period).var()
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / close.shift(1)
+    ret = change.rolling(window=period).var()
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_volatility(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        change = (close-close.shift(1)) / (close-close.shift(1))
-        mean = change.rolling(window=period).mean()
-        std = change.rolling(window=period).std()
-        ret = (change-mean) / std
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    change = (close-close.shift(1)) / (close-close.shift(1))
+    mean = change.rolling(window=period).mean()
+    std = change.rolling(window=period).std()
+    ret = (change-mean) / std
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_volume(symbol, timeframe, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        filename = ('~/py/historical_data/' + symbol + str(timeframe) +
-            '.csv')
-        temp = pd.read_csv( filename, index_col=0, header=0)
-        index = pd.to_datetime(temp.index)
-        temp.index = index
-        ret = temp.iloc[:, 4]
-        ret = ret.shift(shift)
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    ret = load_price(symbol, timeframe, 'volume')
+    ret = ret.shift(shift)
+    ret = fill_data(ret)
     return ret
 
+@cache_pkl
 def i_z_score(symbol, timeframe, period, shift):
-    pkl_file_path = get_pkl_file_path()  # Must put this first.
-    ret = restore_pkl(pkl_file_path)
-    if ret is None:
-        close = i_close(symbol, timeframe, shift)
-        mean = close.rolling(window=period).mean()
-        std = close.rolling(window=period).std()
-        ret = (close-mean) / std
-        ret = fill_data(ret)
-        save_pkl(ret, pkl_file_path)
+    close = i_close(symbol, timeframe, shift)
+    mean = close.rolling(window=period).mean()
+    std = close.rolling(window=period).std()
+    ret = (close-mean) / std
+    ret = fill_data(ret)
+    return ret
+
+# 複数の期間のzスコアをまとめて返す（列は期間）。
+@cache_pkl
+def i_z_score_multi(symbol, timeframe, periods, shift):
+    close = i_close(symbol, timeframe, shift)
+    # 移動平均と移動分散は期間ごとに1回で求め、累積和は全期間で使い回す。
+    moments = {}
+    ret = np.full((len(close), len(periods)), np.nan, order='F')
+    for k in range(len(periods)):
+        mean, var = calc_rolling_window(close.values, periods[k], moments)
+        ret[:, k] = (close.values-mean) / np.sqrt(var)
+    ret = pd.DataFrame(ret, index=close.index, columns=list(periods))
+    ret = fill_data(ret)
+    return ret
+
+# ヒストリカルデータのCSVを列ごとのバイナリファイルに変換する。
+# CSVの解析は最初の1回だけで、以降はload_priceがメモリーマップで読み込む。
+def ingest_historical_data(symbol, timeframe):
+    filename = os.path.expanduser(
+            '~/py/historical_data/' + symbol + str(timeframe) + '.csv')
+    temp = pd.read_csv(filename, index_col=0, header=0)
+    index = pd.to_datetime(temp.index)
+    save_price_store(
+            get_price_store_dir(symbol, timeframe), index,
+            temp.iloc[:, 0], temp.iloc[:, 1], temp.iloc[:, 2],
+            temp.iloc[:, 3], temp.iloc[:, 4])
+
+# キャッシュのエントリーを元データまでさかのぼって削除する。
+# func_nameを指定すればその関数のエントリーを、sourceを指定すればパスに
+# sourceを含む元データを使うエントリーを、それぞれに依存するエントリーごと削除する。
+def invalidate_cache(func_name=None, source=None):
+    manifest = get_manifest()
+    targets = set()
+    for key, entry in manifest.items():
+        if func_name is not None and entry['func'] == func_name:
+            targets.add(key)
+        if source is not None and any(
+                [source in path for path in entry['sources']]):
+            targets.add(key)
+    # 削除するエントリーに依存するエントリーも削除する。
+    while True:
+        dependents = set([key for key, entry in manifest.items()
+                          if key not in targets
+                          and len(targets.intersection(entry['deps'])) > 0])
+        if len(dependents) == 0:
+            break
+        targets |= dependents
+    for key in targets:
+        remove_cache_entry(key)
+        cache_manifest_info['invalidated'] += 1
+    save_manifest()
+    return len(targets)
+
+# 価格データを列ごとのバイナリファイルから読み込む。
+# ファイルはメモリーマップで開くので、OSのページキャッシュをプロセス間で共有できる。
+# バイナリファイルがないか、CSVの方が新しければ先に変換する。
+def load_price(symbol, timeframe, field):
+    # 共有メモリーにあればそれを使う。
+    if (symbol, timeframe) in shared_price:
+        dataset = shared_price[(symbol, timeframe)]
+        if len(cache_stack) > 0:
+            cache_stack[-1]['sources'].update(dataset['sources'])
+        return dataset[field]
+    dirname = get_price_store_dir(symbol, timeframe)
+    time_path = dirname + '/time.npy'
+    csv_path = dirname + '.csv'
+    # その時間足のデータがなければ1分足から作る。
+    if (timeframe != 1 and os.path.exists(time_path) == False
+        and os.path.exists(csv_path) == False):
+        ret = resample_price(symbol, timeframe, field)
+        return ret
+    if (os.path.exists(time_path) == False or (os.path.exists(csv_path)
+        and os.path.getmtime(csv_path) > os.path.getmtime(time_path))):
+        ingest_historical_data(symbol, timeframe)
+        price_index.pop((symbol, timeframe), None)
+    if (symbol, timeframe) not in price_index:
+        epoch = np.load(time_path, mmap_mode='r')
+        price_index[(symbol, timeframe)] = pd.to_datetime(epoch, unit='s')
+    index = price_index[(symbol, timeframe)]
+    # 計算中のi_*関数に元データのフィンガープリントを記録する。
+    if len(cache_stack) > 0:
+        for path in [csv_path, time_path]:
+            if os.path.exists(path) == True:
+                cache_stack[-1]['sources'][path] = get_fingerprint(path)
+    values = np.load(dirname + '/' + field + '.npy', mmap_mode='r')
+    if compact_mode == 1:
+        values = values.astype(np.float32)
+    ret = pd.Series(values, index=index, name=field)
     return ret
 
 def optimize_inputs(ea, symbol, timeframe, spread, start, end, min_trade,
-                    method, rranges):
+                    method, rranges, n_jobs=1, slpips=None, tppips=None,
+                    dataset=None, commission=0.0, swap_long=0.0,
+                    swap_short=0.0):
     def func(inputs, ea, symbol, timeframe, spread, start, end, min_trade):
         buy_entry, buy_exit, sell_entry, sell_exit = ea(inputs, symbol,
                                                         timeframe)
-        buy_position, sell_position = calc_position(
-                buy_entry, buy_exit, sell_entry, sell_exit)
+        exit_price = None
+        if slpips is None and tppips is None:
+            buy_position, sell_position = calc_position(
+                    buy_entry, buy_exit, sell_entry, sell_exit)
+        else:
+            buy_position, sell_position, exit_price = (
+                    calc_position_with_stop(
+                            buy_entry, buy_exit, sell_entry, sell_exit,
+                            symbol, timeframe, slpips, tppips))
+            exit_price = exit_price[start:end]
         buy_position = buy_position[start:end]
         sell_position = sell_position[start:end]
-        trade = calc_trade(buy_position, sell_position, start, end) 
-        pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread)
+        pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread,
+                       exit_price, commission, swap_long, swap_short)
+        metrics = calc_metrics(pnl, timeframe, start, end, buy_position,
+                               sell_position, exit_price)
+        trade = metrics.trade
         if method == 'sharpe':
-            ret = calc_sharpe(pnl, timeframe, start, end)
+            ret = metrics.sharpe
         elif method == 'drawdown':
-            ret = -calc_drawdown(pnl, start, end)
+            ret = -metrics.drawdown
         elif method == 'r2':
-            ret = calc_r2(pnl, start, end)
+            ret = metrics.r2
         start_dt, end_dt = to_datetime(start, end)
         years = ((end_dt-start_dt).total_seconds()+60*60*24) / (60*60*24*365)
         if trade/years < min_trade:
             ret = 0.0
-        del buy_position
-        del sell_position
-        del pnl
-        gc.collect()
         return -ret
 
-    inputs = optimize.brute(
+    # 各プロセスが同時に変換し直さないように、価格データは先に読んでおく。
+    if dataset is None:
+        load_price(symbol, timeframe, 'close')
+    # n_jobs=1ならbruteと同様に1コアで順番に評価する。
+    inputs, scores = grid_search(
             func, rranges, args=(
                     ea, symbol, timeframe, spread, start, end, min_trade),
-                    finish=None)
-    if(isinstance(inputs, np.ndarray)==False):
-        inputs = np.array([inputs])
+                    n_jobs=n_jobs, dataset=dataset)
     return inputs
 
+# コンパクトモードでpklファイルに保存する形にする。
+# 時間インデックスがprice_indexのどれかと同じなら、値と列名だけを持つ辞書にし、
+# 読み込むときにunpack_compactで共有のインデックスを付け直す。
+def pack_compact(data):
+    if isinstance(data, (pd.Series, pd.DataFrame)) == False:
+        return data
+    for key, index in list(price_index.items()):
+        if (data.index.is_(index) or (len(data.index) == len(index)
+            and data.index.equals(index))):
+            ret = {'compact_index': key, 'values': data.values}
+            if isinstance(data, pd.Series):
+                ret['name'] = data.name
+            else:
+                ret['columns'] = data.columns
+            return ret
+    return data
+
+# ウォークフォワードテストの各フォールドの期間を求める。
+# 戻り値はフォールドごとの(start_train, end_train, start_test, end_test)の
+# リストと、アウトオブサンプル全体の開始日時、終了日時。
+def plan_walk_forward(start, end, timeframe, in_sample_period,
+                      out_of_sample_period):
+    start_dt = datetime.strptime(start + ' 00:00', '%Y-%m-%d %H:%M')
+    end_dt = datetime.strptime(end + ' 23:59', '%Y-%m-%d %H:%M')
+    folds = []
+    end_test_dt = start_dt
+    i = 0
+    while True:
+        start_train_dt = start_dt + timedelta(
+            days=-in_sample_period+out_of_sample_period*i)
+        end_train_dt = (start_train_dt + timedelta(days=in_sample_period)
+            - timedelta(minutes=timeframe))
+        start_test_dt = end_train_dt + timedelta(minutes=timeframe)
+        if i == 0:
+            start_all_dt = start_test_dt
+        if (start_test_dt + timedelta(days=out_of_sample_period)
+            - timedelta(minutes=timeframe)) > end_dt:
+            end_all_dt = end_test_dt
+            break
+        end_test_dt = (
+            start_test_dt + timedelta(days=out_of_sample_period)
+            - timedelta(minutes=timeframe))
+        folds.append((str(start_train_dt), str(end_train_dt),
+                      str(start_test_dt), str(end_test_dt)))
+        i += 1
+    return folds, str(start_all_dt), str(end_all_dt)
+
+# 資産曲線を描いてfilenameに保存する。
+# pyplotを使わずにFigureを直接作るので、メインスレッド以外でも描ける。
+# background=1ならスレッドで描き、戻り値のスレッドをjoinすれば完了を待てる。
+# show=1ならpyplotで作って保存した後に表示する（メインスレッドで使うこと）。
+def plot_equity(equity, filename='backtest.png', title='Backtest',
+                background=0, show=0):
+    def plot():
+        if show == 1:
+            fig = plt.figure()
+        else:
+            fig = Figure()
+        ax = fig.add_subplot()
+        ax.plot(equity)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.set_title(title)
+        ax.set_xlabel('Date')
+        ax.set_ylabel('Equity Curve')
+        fig.tight_layout()
+        fig.savefig(filename, dpi=150)
+        if show == 1:
+            plt.show()
+            plt.close(fig)
+    if background == 1:
+        thread = threading.Thread(target=plot)
+        thread.start()
+        return thread
+    plot()
+
+# バックテストの成績の表を表示用に丸めて表示する。
+def print_table(table):
+    table = table.copy()
+    for column in table.columns:
+        if table[column].dtype == float:
+            table[column] = [str(np.round(value, 2))
+                             for value in table[column]]
+    table['trade'] = [str(trade) for trade in table['trade']]
+    # パラメータがなければ列ごと表示しない。
+    if 'inputs' in table.columns:
+        if table['inputs'].isna().all() == True:
+            table = table.drop('inputs', axis=1)
+        else:
+            table['inputs'] = ['' if inputs is None
+                               else str(np.round(inputs, 2))
+                               for inputs in table['inputs']]
+    pd.set_option('display.max_columns', 100)
+    pd.set_option('display.width', 1000)
+    print(table)
+
+# 銘柄、時間足の価格とi_*関数の戻り値を共有メモリーに置く。
+# indicatorsは(i_*関数, 引数のタプル)のリスト。戻り値のデータセットは
+# 子プロセスに渡してattach_datasetでアタッチし、使い終わったら親プロセスで
+# release_datasetを呼ぶ。インデックスが価格と違う戻り値や数値でない戻り値、
+# cache_pklでキャッシュしない関数の戻り値は共有しない（子プロセスで普通に
+# 計算する）。途中で失敗すれば作った共有メモリーを解放する。
+def publish_dataset(symbol, timeframe, indicators=()):
+    cache_stack.append({'sources': {}, 'deps': set()})
+    try:
+        price = {field: load_price(symbol, timeframe, field)
+                 for field in price_fields}
+    finally:
+        frame = cache_stack.pop()
+    index = price['close'].index
+    dataset = {'symbol': symbol, 'timeframe': timeframe,
+               'compact': compact_mode, 'sources': frame['sources'],
+               'index': share_array(index.asi8), 'price': {}, 'cache': {}}
+    dataset['id'] = dataset['index'][0]
+    try:
+        for field in price_fields:
+            dataset['price'][field] = share_array(price[field].values)
+        for func, args in indicators:
+            data = func(*args)
+            if (data.index.equals(index) == False
+                or data.values.dtype.kind not in 'biuf'):
+                continue
+            func_name = func.__name__
+            if compact_mode == 1:
+                func_name += '_f32'
+            cache_key = os.path.basename(get_cache_file_path(
+                    func_name, inspect.signature(func), args, {}))
+            manifest_entry = get_manifest().get(cache_key)
+            if manifest_entry is None:
+                continue
+            entry = {'values': share_array(data.values),
+                     'sources': manifest_entry['sources']}
+            if isinstance(data, pd.DataFrame):
+                entry['columns'] = data.columns
+            else:
+                entry['name'] = data.name
+            dataset['cache'][cache_key] = entry
+    except BaseException:
+        release_dataset(dataset)
+        raise
+    return dataset
+
+# MT4の.hstファイルを読み込む。
+# 148バイトのヘッダーの後の44バイトのバーを構造化dtypeで一括して読み込む。
+def read_hst(filename):
+    dtype = np.dtype([('time', '<i4'), ('open', '<f8'),
+                      ('low', '<f8'),  # it's not mistake.
+                      ('high', '<f8'),  # it's not mistake too.
+                      ('close', '<f8'), ('volume', '<f8')])
+    bar = np.fromfile(filename, dtype=dtype, offset=148)
+    index = pd.to_datetime(bar['time'].astype(np.int64), unit='s')
+    ret = pd.DataFrame(index=index)
+    for field in price_fields:
+        ret[field] = bar[field]
+    return ret
+
+# キャッシュのエントリーを記録し、容量が上限を超えていれば削除する。
+def record_cache_entry(key, func_name, frame):
+    manifest = get_manifest()
+    path = get_temp_dir() + key
+    manifest[key] = {'func': func_name, 'sources': frame['sources'],
+                     'deps': sorted(frame['deps']),
+                     'bytes': os.path.getsize(path), 'atime': time.time()}
+    cache_manifest_info['deleted'].discard(key)
+    evict_cache(keep=key)
+    cache_manifest_info['dirty'] = 1
+    # manifest.jsonの書き込みは多くても5秒に1回とし、残りは終了時に書く。
+    if time.time() - cache_manifest_info['saved'] > 5.0:
+        save_manifest()
+
+# publish_datasetで作ったデータセットの共有メモリーを解放する。
+def release_dataset(dataset):
+    key = (dataset['symbol'], dataset['timeframe'])
+    if shared_price.get(key, {}).get('id') == dataset['id']:
+        del shared_price[key]
+        price_index.pop(key, None)
+    for cache_key in dataset['cache']:
+        shared_cache.pop(cache_key, None)
+    gc.collect()
+    specs = [dataset['index']] + list(dataset['price'].values())
+    specs += [entry['values'] for entry in dataset['cache'].values()]
+    for name, dtype, shape in specs:
+        block = shared_blocks.pop(name, None)
+        if block is None:
+            continue
+        block.unlink()
+        # 配列がまだ使われていれば、その配列がなくなったときに解放される。
+        try:
+            block.close()
+        except BufferError:
+            pass
+
+# キャッシュのエントリーをpklファイル、メモリー、管理情報から削除する。
+def remove_cache_entry(key):
+    path = get_temp_dir() + key
+    if os.path.exists(path) == True:
+        os.remove(path)
+    if path in memory_cache:
+        memory_cache_info['bytes'] -= get_nbytes(memory_cache.pop(path))
+    get_manifest().pop(key, None)
+    cache_manifest_info['deleted'].add(key)
+    cache_manifest_info['dirty'] = 1
+
 def rename_historical_data_filename(symbol):
     new_name = './historical_data/' + symbol + '.csv'
     for old_name in glob.glob('./historical_data/' + symbol + '*'):
         os.rename(old_name, new_name)
 
+# 1分足から任意の時間足の価格データを作る。
+# 始値は最初、高値は最大、安値は最小、終値は最後の1分足、出来高は合計とし、
+# 足の時刻は区間の始まりとする（日足までは1970年1月1日から等間隔、
+# 週足は日曜日、月足は月初めで区切る）。
+# 作ったデータはresampled_priceに保存し、1分足が更新されるまで使い回す。
+def resample_price(symbol, timeframe, field):
+    # 1分足を読むことで、元データのフィンガープリントも記録される。
+    close = load_price(symbol, 1, 'close')
+    key = (symbol, timeframe)
+    mtime = os.path.getmtime(get_price_store_dir(symbol, 1) + '/time.npy')
+    if key not in resampled_price or resampled_price[key]['mtime'] != mtime:
+        epoch = close.index.asi8 // 10**9
+        if timeframe == 43200:
+            month = close.index.values.astype('datetime64[M]')
+            bucket = month.astype(np.int64)
+        elif timeframe == 10080:
+            # 1970年1月1日は木曜日なので、4日ずらして日曜日で区切る。
+            bucket = (epoch//86400+4) // 7
+        else:
+            bucket = epoch // (timeframe*60)
+        starts = np.flatnonzero(np.diff(bucket)!=0) + 1
+        starts = np.concatenate([[0], starts])
+        ends = np.append(starts[1:], len(bucket))
+        if timeframe == 43200:
+            bar_time = month[starts].astype('datetime64[s]').astype(np.int64)
+        elif timeframe == 10080:
+            bar_time = (bucket[starts]*7-4) * 86400
+        else:
+            bar_time = bucket[starts] * (timeframe*60)
+        data = {'mtime': mtime}
+        data['open'] = load_price(symbol, 1, 'open').values[starts]
+        data['high'] = np.fmax.reduceat(
+                load_price(symbol, 1, 'high').values, starts)
+        data['low'] = np.fmin.reduceat(
+                load_price(symbol, 1, 'low').values, starts)
+        data['close'] = close.values[ends-1]
+        data['volume'] = np.add.reduceat(
+                load_price(symbol, 1, 'volume').values, starts)
+        price_index[key] = pd.to_datetime(bar_time, unit='s')
+        resampled_price[key] = data
+    values = resampled_price[key][field]
+    if compact_mode == 1:
+        values = values.astype(np.float32)
+    ret = pd.Series(values, index=price_index[key], name=field)
+    return ret
+
+# メモリー上のキャッシュからデータを取り出す。なければNoneを返す。
+def restore_memory(key):
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        memory_cache_info['hits'] += 1
+        ret = memory_cache[key]
+    else:
+        memory_cache_info['misses'] += 1
+        ret = None
+    return ret
+
 def restore_model(filename):
     pathname = os.path.dirname(__file__) + '/' + filename
     if os.path.exists(filename) == True:
@@ -1198,23 +2522,150 @@ def restore_model(filename):
 def restore_pkl(pkl_file_path):
     if os.path.exists(pkl_file_path) == True:
         ret = joblib.load(pkl_file_path)
+        if isinstance(ret, dict) and 'cache_data' in ret:
+            ret = ret['cache_data']
+        ret = unpack_compact(ret)
     else:
         ret = None
     return ret
 
+# ウォークフォワードテストの1フォールドを実行する。
+# インサンプルで最適化し、アウトオブサンプルのトレード数と損益を返す。
+# datasetがあればアタッチし、最適化の各プロセスにも渡す。
+def run_walk_forward_fold(ea, symbol, timeframe, spread, fold, min_trade,
+                          method, rranges, n_jobs=1, slpips=None,
+                          tppips=None, commission=0.0, swap_long=0.0,
+                          swap_short=0.0, dataset=None):
+    if dataset is not None:
+        attach_dataset(dataset)
+    start_train, end_train, start_test, end_test = fold
+    inputs = optimize_inputs(
+            ea, symbol, timeframe, spread, start_train, end_train,
+            min_trade, method, rranges, n_jobs, slpips, tppips, dataset,
+            commission, swap_long, swap_short)
+    buy_entry, buy_exit, sell_entry, sell_exit = ea(
+            inputs, symbol, timeframe)
+    exit_price = None
+    if slpips is None and tppips is None:
+        buy_position, sell_position = calc_position(
+                buy_entry, buy_exit, sell_entry, sell_exit)
+    else:
+        buy_position, sell_position, exit_price = calc_position_with_stop(
+                buy_entry, buy_exit, sell_entry, sell_exit, symbol,
+                timeframe, slpips, tppips)
+        exit_price = exit_price[start_test:end_test]
+    buy_position = buy_position[start_test:end_test]
+    sell_position = sell_position[start_test:end_test]
+    trade = calc_trade(buy_position, sell_position, start_test, end_test,
+                       exit_price)
+    pnl = calc_pnl(buy_position, sell_position, symbol, timeframe, spread,
+                   exit_price, commission, swap_long, swap_short)
+    pnl = pnl[start_test:end_test]
+    return inputs, trade, pnl
+
+# キャッシュの管理情報をmanifest.jsonに保存する。
+# 他のプロセスが書いた分を消さないように、読み込み直してからマージする。
+def save_manifest():
+    if cache_manifest is None or cache_manifest_info['dirty'] == 0:
+        return
+    path = get_temp_dir() + 'manifest.json'
+    manifest = {}
+    if os.path.exists(path) == True:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            manifest = {}
+    for key in cache_manifest_info['deleted']:
+        manifest.pop(key, None)
+    manifest.update(cache_manifest)
+    # 他のプロセスと一時ファイルが重ならないようにする。
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+    cache_manifest_info['dirty'] = 0
+    cache_manifest_info['saved'] = time.time()
+
+# メモリー上のキャッシュにデータを保存する。
+# 上限のバイト数を超えたら最も長く使われていないものから削除する。
+def save_memory(data, key):
+    nbytes = get_nbytes(data)
+    if nbytes > memory_cache_info['max_bytes']:
+        return
+    if key in memory_cache:
+        memory_cache_info['bytes'] -= get_nbytes(memory_cache.pop(key))
+    memory_cache[key] = data
+    memory_cache_info['bytes'] += nbytes
+    while memory_cache_info['bytes'] > memory_cache_info['max_bytes']:
+        key, data = memory_cache.popitem(last=False)
+        memory_cache_info['bytes'] -= get_nbytes(data)
+
 def save_model(model, filename):
     pathname = os.path.dirname(__file__) + '/' + filename
     if os.path.exists(pathname) == False:
         os.mkdir(pathname)
     joblib.dump(model, pathname + '/' + filename + '.pkl') 
 
-def save_pkl(data, pkl_file_path):
-    joblib.dump(data, pkl_file_path)
+# pklファイルには戻り値とともに管理情報のエントリー（関数名、元データ、
+# 依存するエントリー）を保存し、他のプロセスでも取り込めるようにする。
+# 読み込み中のプロセスがあってもよいように、別名で書いてから置き換える。
+def save_pkl(data, pkl_file_path, func_name, frame):
+    if compact_mode == 1:
+        data = pack_compact(data)
+    payload = {'cache_data': data, 'func': func_name,
+               'sources': frame['sources'], 'deps': sorted(frame['deps'])}
+    temp_path = pkl_file_path + '.' + str(os.getpid()) + '.tmp'
+    joblib.dump(payload, temp_path)
+    os.replace(temp_path, pkl_file_path)
+
+# 価格データを列ごとのバイナリファイルに保存する。
+# 時間はエポック秒のint64、各価格はfloat64で1項目1ファイルとする。
+def save_price_store(dirname, index, op, high, low, close, volume):
+    if os.path.exists(dirname) == False:
+        os.makedirs(dirname)
+    epoch = pd.DatetimeIndex(index).asi8 // 10**9
+    data = {'open': op, 'high': high, 'low': low, 'close': close,
+            'volume': volume}
+    # 複数のプロセスが同時に変換しても一時ファイルがぶつからないようにする。
+    suffix = '.' + str(os.getpid()) + '.tmp.npy'
+    for field in price_fields:
+        values = np.ascontiguousarray(data[field], dtype=np.float64)
+        np.save(dirname + '/' + field + suffix, values)
+        os.replace(dirname + '/' + field + suffix,
+                   dirname + '/' + field + '.npy')
+    # time.npyを最後に書くことで、変換途中のデータを読まないようにする。
+    np.save(dirname + '/time' + suffix, epoch.astype(np.int64))
+    os.replace(dirname + '/time' + suffix, dirname + '/time.npy')
 
 def seconds():
     ret = datetime.now().second
     return ret
 
+# コンパクトモードを設定する（1で有効、0で無効）。
+# 精度の違う値が混ざらないように、メモリー上のキャッシュは消す。
+def set_compact_mode(flag):
+    global compact_mode
+    compact_mode = flag
+    clear_memory_cache()
+
+# メモリー上のキャッシュの上限（バイト）を設定する。
+def set_memory_cache_size(max_bytes):
+    memory_cache_info['max_bytes'] = max_bytes
+    while memory_cache_info['bytes'] > max_bytes and len(memory_cache) > 0:
+        key, data = memory_cache.popitem(last=False)
+        memory_cache_info['bytes'] -= get_nbytes(data)
+
+# 配列を共有メモリーにコピーし、attach_arrayに渡す(名前, 型, 形)を返す。
+def share_array(values):
+    values = np.ascontiguousarray(values)
+    block = shared_memory.SharedMemory(create=True,
+                                       size=max(values.nbytes, 1))
+    array = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    array[:] = values
+    shared_blocks[block.name] = block
+    return (block.name, values.dtype.str, values.shape)
+
 def time_day(index):
     ret = pd.Series(index.day, index=index)
     return ret
@@ -1242,49 +2693,242 @@ def time_week_of_month(index):
     ret = (np.ceil(day / 7)).astype(int)
     return ret
 
-def to_csv_file(symbol):
+# dataにread_hstで読み込んだデータを渡せば.hstファイルは読まない。
+def to_csv_file(symbol, data=None):
     filename_hst = './historical_data/' + symbol + '.hst'
     filename_csv = './historical_data/' + symbol + '.csv'
-    read = 0
-    datetime = []
-    open_price = []
-    low_price = []
-    high_price = []
-    close_price = []
-    volume = []
-    with open(filename_hst, 'rb') as f:
-        while True:
-            if read >= 148:
-                buf = f.read(44)
-                read += 44
-                if not buf:
-                    break
-                bar = struct.unpack('< iddddd', buf)
-                datetime.append(
-                    time.strftime('%Y-%m-%d %H:%M:%S',
-                    time.gmtime(bar[0])))
-                open_price.append(bar[1])
-                high_price.append(bar[3])  # it's not mistake.
-                low_price.append(bar[2])  # it's not mistake too.
-                close_price.append(bar[4])
-                volume.append(bar[5])
-            else:
-                buf = f.read(148)
-                read += 148
-    data = {'0_datetime':datetime, '1_open_price':open_price,
-        '2_high_price':high_price, '3_low_price':low_price,
-        '4_close_price':close_price, '5_volume':volume}
-    result = pd.DataFrame.from_dict(data)
-    result.columns = ['Time (UTC)', 'Open', 'High', 'Low', 'Close',
-                      'Volume']
-    result = result.set_index('Time (UTC)')
-    result.to_csv(filename_csv)
+    if data is None:
+        data = read_hst(filename_hst)
+    result = data.copy()
+    result.columns = ['Open', 'High', 'Low', 'Close', 'Volume']
+    result.index.name = 'Time (UTC)'
+    result.to_csv(filename_csv, date_format='%Y-%m-%d %H:%M:%S')
 
 def to_datetime(start, end):
     start = datetime.strptime(start[:10], '%Y-%m-%d')# + ' 00:00', '%Y.%m.%d %H:%M')
     end = datetime.strptime(end[:10], '%Y-%m-%d')# + ' 23:59', '%Y.%m.%d %H:%M')
     return start, end
 
+# float64の値をfloat32にする（それ以外の型の列はそのまま）。
+def to_float32(data):
+    if isinstance(data, pd.Series):
+        if data.dtype == np.float64:
+            data = data.astype(np.float32)
+    elif isinstance(data, pd.DataFrame):
+        columns = data.columns[data.dtypes==np.float64]
+        if len(columns) > 0:
+            data = data.astype({column: np.float32 for column in columns})
+    return data
+
+# MT4の.hstファイルを列ごとのバイナリファイルに変換する。
+# csv=1ならCSVファイルも書き出す（CSVファイルの方が新しいとload_priceが
+# 読み直すので、先に書き出す）。
+def to_npy_file(symbol, csv=0):
+    filename_hst = './historical_data/' + symbol + '.hst'
+    data = read_hst(filename_hst)
+    if csv == 1:
+        to_csv_file(symbol, data)
+    save_price_store(
+            './historical_data/' + symbol, data.index, data['open'],
+            data['high'], data['low'], data['close'], data['volume'])
+
 def to_period(minute, timeframe):
     period = int(minute / timeframe)
-    return period
\ No newline at end of file
+    return period
+
+# pack_compactで保存した値に共有の時間インデックスを付け直す。
+def unpack_compact(data):
+    if isinstance(data, dict) == False or 'compact_index' not in data:
+        return data
+    symbol, timeframe = data['compact_index']
+    if (symbol, timeframe) not in price_index:
+        load_price(symbol, timeframe, 'close')
+    index = price_index[(symbol, timeframe)]
+    if 'columns' in data:
+        ret = pd.DataFrame(data['values'], index=index,
+                           columns=data['columns'])
+    else:
+        ret = pd.Series(data['values'], index=index, name=data['name'])
+    return ret
+
+# ストリームに足を渡して指標を更新し、最新の値を返す。
+# 配列を渡すとまとめて更新し、値の配列を返す（hl_bandは列がhigh、low、
+# middleの2次元配列）。pandasのrollingと同じ順序で加減算するので、
+# ウォームアップ後の値は同じ期間、シフトのi_*関数とビット単位で一致する。
+# ウォームアップ中は未来のデータで補完できないのでNaNを返す。
+def update_stream(stream, high, low, close):
+    if np.ndim(close) > 0:
+        ret = []
+        for h, l, c in zip(high, low, close):
+            ret.append(update_stream(stream, h, l, c))
+        return np.array(ret)
+    # 欠損値は前の足の値で補完する。
+    if not np.isnan(high):
+        stream['high'] = np.float64(high)
+    if not np.isnan(low):
+        stream['low'] = np.float64(low)
+    if not np.isnan(close):
+        stream['close'] = np.float64(close)
+    stream['bars'].append((stream['high'], stream['low'], stream['close']))
+    high, low, close = stream['bars'][0]
+    indicator = stream['indicator']
+    period = stream['period']
+    prev_close = stream['prev_close']
+    stream['prev_close'] = close
+    if indicator == 'atr':
+        value = high - low
+        if not np.isnan(prev_close):
+            value = max(value, high-prev_close, prev_close-low)
+    elif indicator == 'std':
+        value = (close-prev_close) / prev_close
+    else:
+        value = close
+    window = stream['window']
+    window.append((high, low, value))
+    old = None
+    if len(window) > period:
+        old = window.popleft()
+    no = stream['no']
+    stream['no'] = no + 1
+    if indicator == 'hl_band':
+        band_high = update_stream_max(stream['max'], no, high, period)
+        band_low = -update_stream_max(stream['min'], no, -low, period)
+        if len(window) < period or np.isnan(band_high+band_low):
+            return (np.nan, np.nan, np.nan)
+        return (band_high, band_low, (band_high+band_low) / 2)
+    if old is not None:
+        old = old[2]
+    if indicator == 'std' or indicator == 'z_score':
+        var = update_stream_var(stream['var'], value, old, period)
+        std = np.sqrt(max(var, 0.0))
+    if indicator != 'std':
+        mean = update_stream_mean(stream['mean'], value, old, period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if indicator == 'atr' or indicator == 'ma':
+            ret = mean
+        elif indicator == 'kairi':
+            ret = (close-mean) / mean * 100.0
+        elif indicator == 'std':
+            ret = std
+        elif indicator == 'trend_duration':
+            ret = update_stream_trend(stream, mean)
+        elif indicator == 'z_score':
+            ret = (close-mean) / std
+    # i_*関数のfill_dataと同じく、無限大と欠損値は前の値で補完する。
+    if np.isnan(ret) or np.isinf(ret):
+        return stream['last']
+    stream['last'] = ret
+    return ret
+
+# ストリームの直近period本の最大値を単調減少の両端キューで更新する。
+def update_stream_max(queue, no, value, period):
+    while len(queue) > 0 and queue[0][0] <= no-period:
+        queue.popleft()
+    if not np.isnan(value):
+        while len(queue) > 0 and queue[-1][1] <= value:
+            queue.pop()
+        queue.append((no, value))
+    if len(queue) == 0:
+        return np.nan
+    return queue[0][1]
+
+# ストリームの移動平均を更新する。
+# pandasのroll_meanと同じカハンの加算、減算と同値の扱いをなぞる。
+def update_stream_mean(acc, value, old, period):
+    # 期間が1のときはpandasと同様に毎回集計をやり直す。
+    if period == 1:
+        acc.update(nobs=0, sum=0.0, neg=0, add=0.0, remove=0.0, same=0,
+                   prev=value)
+    elif old is not None and not np.isnan(old):
+        acc['nobs'] -= 1
+        y = -old - acc['remove']
+        t = acc['sum'] + y
+        acc['remove'] = t - acc['sum'] - y
+        acc['sum'] = t
+        if np.signbit(old):
+            acc['neg'] -= 1
+    if not np.isnan(value):
+        acc['nobs'] += 1
+        y = value - acc['add']
+        t = acc['sum'] + y
+        acc['add'] = t - acc['sum'] - y
+        acc['sum'] = t
+        if np.signbit(value):
+            acc['neg'] += 1
+        if value == acc['prev']:
+            acc['same'] += 1
+        else:
+            acc['same'] = 1
+        acc['prev'] = value
+    nobs = acc['nobs']
+    if nobs < period or nobs == 0:
+        return np.nan
+    ret = acc['sum'] / nobs
+    if acc['same'] >= nobs:
+        ret = acc['prev']
+    elif acc['neg'] == 0 and ret < 0.0:
+        ret = 0.0
+    elif acc['neg'] == nobs and ret > 0.0:
+        ret = 0.0
+    return ret
+
+# ストリームのトレンドの継続期間を更新する。
+def update_stream_trend(stream, ma):
+    if np.isnan(ma):
+        return np.nan
+    if stream['above'] is None:
+        # i_*関数は最初の移動平均で過去の足を補完して比べるので、
+        # 最初の移動平均が出たときにウィンドウ内の足をさかのぼって数える。
+        bars = list(stream['window'])
+        stream['above'] = 0
+        stream['below'] = 0
+    else:
+        bars = [stream['window'][-1]]
+    for high, low, close in bars:
+        if stream['mode'] == 'close':
+            above = close > ma
+            below = close < ma
+        elif stream['mode'] == 'highlow':
+            above = low > ma
+            below = high < ma
+        stream['above'] = stream['above'] + 1 if above else 0
+        stream['below'] = stream['below'] + 1 if below else 0
+    return (stream['above']-stream['below']) / stream['period']
+
+# ストリームの移動分散（不偏）を更新する。
+# pandasのroll_varと同じカハンの補正付きのWelford法をなぞる。
+def update_stream_var(acc, value, old, period):
+    if period == 1:
+        acc.update(nobs=0.0, mean=0.0, ssqdm=0.0, add=0.0, remove=0.0,
+                   same=0, prev=value)
+    elif old is not None and not np.isnan(old):
+        acc['nobs'] -= 1
+        if acc['nobs']:
+            prev_mean = acc['mean'] - acc['remove']
+            y = old - acc['remove']
+            t = y - acc['mean']
+            acc['remove'] = t + acc['mean'] - y
+            acc['mean'] = acc['mean'] - t/acc['nobs']
+            acc['ssqdm'] = acc['ssqdm'] - (old-prev_mean)*(old-acc['mean'])
+        else:
+            acc['mean'] = 0.0
+            acc['ssqdm'] = 0.0
+    if not np.isnan(value):
+        acc['nobs'] += 1
+        if value == acc['prev']:
+            acc['same'] += 1
+        else:
+            acc['same'] = 1
+        acc['prev'] = value
+        prev_mean = acc['mean'] - acc['add']
+        y = value - acc['add']
+        t = y - acc['mean']
+        acc['add'] = t + acc['mean'] - y
+        acc['mean'] = acc['mean'] + t/acc['nobs']
+        acc['ssqdm'] = acc['ssqdm'] + (value-prev_mean)*(value-acc['mean'])
+    nobs = acc['nobs']
+    if nobs < period or nobs <= 1:
+        return np.nan
+    if acc['same'] >= nobs:
+        return 0.0
+    return acc['ssqdm'] / (nobs-1)
\ No newline at end of file